@@ -4,13 +4,32 @@ data_gen - The module to generate data from questionnaires
 
 __version__ = "0.1.0"
 
-def generate_data(path_list):
+import asyncio
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import ast
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+from telemetry import collector
+
+def generate_data(path_list, max_workers: int = 1):
     """
     Generates a single pandas DataFrame by processing a list of JSON files containing questionnaire data.
 
     :param path_list: A list of file paths to JSON files. Each JSON file is expected to contain a structure 
                   with an 'options' key for nested data and 'question' and 'type' keys for metadata.
     :type path_list: list of str
+    :param max_workers: The number of processes reading and normalizing the files in parallel. ``1`` reads them one after another in the current process.
+    :type max_workers: int
     :return: A pandas DataFrame with the following columns:
                  
                  - Columns from the 'options' key in the JSON data.
@@ -19,27 +38,25 @@ def generate_data(path_list):
                  - 'questionnaire': An identifier for the questionnaire, incremented for each JSON file in the input list.
     :rtype: pandas.DataFrame
     """
-    df_list = []
-    i=1
-    for path in path_list:
-        with open(path, 'r') as f:
-            data = json.load(f)
-        df = pd.json_normalize(data, record_path='options', meta=['question', 'type'])
-        df['questionnaire'] = i
-        i+=1
-        df_list.append(df)  # Append the DataFrame to the list
-    dfq1 = pd.concat(df_list, axis=0)  # Concatenate all DataFrames in the list
+    with collector.stage('read.questionnaires', items=len(path_list)):
+        dfq1 = pd.concat(iter_questionnaires(path_list, max_workers=max_workers), axis=0)  # Concatenate all DataFrames
     return dfq1
 #path_list = ['/content/sample_data/questionnaire1.json','/content/sample_data/questionnaire2.json','/content/sample_data/questionnaire3.json',
 #             '/content/sample_data/questionnaire4.json','/content/sample_data/questionnaire5.json']
 
-def generate_data_web(path_list):
+def generate_data_web(path_list, max_workers: int = 8, retries: int = 3, cache_dir: str = None):
     """
     Generates a single pandas DataFrame by processing a list of JSON files containing questionnaire data.
 
     :param path_list: A list of file paths to JSON files, which can be stored online. Each JSON file is expected to contain a structure 
                   with an 'options' key for nested data and 'question' and 'type' keys for metadata.
     :type path_list: list of str
+    :param max_workers: The number of URLs fetched concurrently over a pooled HTTP session.
+    :type max_workers: int
+    :param retries: The number of retries of a request that fails to connect or gets a 429 or 5xx response, see :py:func:`data_gen.iter_questionnaires`.
+    :type retries: int
+    :param cache_dir: Optional directory in which the downloaded questionnaires are kept, so they are not fetched again.
+    :type cache_dir: str or None
     :return: A pandas DataFrame with the following columns:
     
                  - Columns from the 'options' key in the JSON data.
@@ -48,21 +65,94 @@ def generate_data_web(path_list):
                  - 'questionnaire': An identifier for the questionnaire, incremented for each JSON file in the input list.
     :rtype: pandas.DataFrame
     """
-    df_list = []
-    i = 1
-    for path in path_list:
-        # Use requests to fetch data from URL
-        response = requests.get(path)
-        response.raise_for_status()  # Raise an exception for bad responses
-        data = response.json()  
-        
-        df = pd.json_normalize(data, record_path='options', meta=['question', 'type'])
-        df['questionnaire'] = i
-        i += 1
-        df_list.append(df)  
-    dfq1 = pd.concat(df_list, axis=0)  
+    with collector.stage('read.questionnaires', items=len(path_list)):
+        dfq1 = pd.concat(iter_questionnaires(path_list, web=True, max_workers=max_workers, retries=retries, cache_dir=cache_dir), axis=0)
     return dfq1
 
+def iter_questionnaires(path_list, web: bool = False, max_workers: int = 1, retries: int = 3, cache_dir: str = None):
+    """
+    Yields one DataFrame per questionnaire, in the order of ``path_list``, without holding all questionnaires in memory at once.
+
+    Local files are read and normalized in a process pool, URLs are fetched concurrently with a pooled ``requests.Session``.
+    A request that fails to connect or gets a 429 or 5xx response is retried with exponential backoff, honouring a ``Retry-After`` header.
+    With a ``cache_dir``, every downloaded questionnaire is stored under a hash of its URL and read from there on the next run.
+    At most ``2 * max_workers`` questionnaires are loaded ahead of the one being consumed.
+
+    :param path_list: A list of file paths or URLs to JSON files in the format expected by :py:func:`data_gen.generate_data`.
+    :type path_list: iterable of str
+    :param web: If True, the paths are URLs and are fetched over HTTP.
+    :type web: bool
+    :param max_workers: The number of processes (local files) or threads (URLs) loading questionnaires in parallel.
+    :type max_workers: int
+    :param retries: The number of retries of a failed request to a URL.
+    :type retries: int
+    :param cache_dir: Optional directory in which the downloaded questionnaires are kept. It is created if it does not exist.
+    :type cache_dir: str or None
+    :return: A generator of DataFrames with the same columns as :py:func:`data_gen.generate_data`, with 'questionnaire' counting up from 1.
+    :rtype: generator of pandas.DataFrame
+    """
+    if web:
+        session = requests.Session()
+        retry = requests.adapters.Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        load = functools.partial(_fetch_questionnaire, session, cache_dir=cache_dir)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    elif max_workers > 1:
+        session = None
+        load = _read_questionnaire
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        for i, path in enumerate(path_list, 1):
+            yield _read_questionnaire(path).assign(questionnaire=i)
+        return
+    try:
+        pending = collections.deque()
+        paths = iter(path_list)
+        for path in itertools.islice(paths, 2 * max_workers):
+            pending.append(executor.submit(load, path))
+        i = 1
+        while pending:
+            df = pending.popleft().result()
+            for path in itertools.islice(paths, 1): #keep the window of loading questionnaires full
+                pending.append(executor.submit(load, path))
+            yield df.assign(questionnaire=i)
+            i += 1
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if session is not None:
+            session.close()
+
+def _read_questionnaire(path: str) -> object:
+    """
+    Reads a questionnaire from a local JSON file into a DataFrame with one row per option.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    return pd.json_normalize(data, record_path='options', meta=['question', 'type'])
+
+def _fetch_questionnaire(session: object, url: str, cache_dir: str = None) -> object:
+    """
+    Fetches a questionnaire from a URL into a DataFrame with one row per option, reading and writing the download cache if a ``cache_dir`` is given.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+        if os.path.exists(cache_path):
+            return _read_questionnaire(cache_path)
+    response = session.get(url)
+    response.raise_for_status()  # Raise an exception for bad responses
+    data = response.json()
+    if cache_path is not None:
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, cache_path) #an interrupted download leaves no partial file in the cache
+    return pd.json_normalize(data, record_path='options', meta=['question', 'type'])
+
 def init_context(context: str) -> object:
     """
     Initialises a new chat window with the desired context.
@@ -77,6 +167,7 @@ def init_context(context: str) -> object:
         {"role": "user", "parts": f"{context}"} #the chat history is filled with a user msg.
       ]
      )
+    chat.context = context #remembered for the prompt cache key, as the history grows with every message
     return chat
 
 def reset_context()->object:
@@ -87,16 +178,59 @@ def reset_context()->object:
     :rtype: object
     """
     chat = model.start_chat()
+    chat.context = ''
     return chat
 
-def generate_q_dataset(question_row: str, chat: object)->object:
+def fork_chat(chat: object) -> object:
+    """
+    Returns a chat with the same context as ``chat`` for a worker thread, so that concurrent requests do not share one chat history.
+
+    A chat of the chat interface is not thread-safe, as its `send_message` method reads and rewrites the chat history without a lock.
+    A chat from :py:func:`data_gen.init_context` or :py:func:`data_gen.reset_context` is therefore started anew from its context on the same model.
+    An object with a ``fork`` method returns its own copy, and any other object, e.g. a :py:class:`data_gen.FakeChat`, is assumed to be thread-safe and is shared.
+
+    :param chat: An object representing the chat interface.
+    :type chat: object
+    :return: The chat to be used by one worker thread.
+    :rtype: object
+    """
+    if hasattr(chat, 'fork'):
+        return chat.fork()
+    chat_model = getattr(chat, 'model', None)
+    if not hasattr(chat_model, 'start_chat'):
+        return chat
+    context = getattr(chat, 'context', '')
+    forked = chat_model.start_chat(history=[{"role": "user", "parts": f"{context}"}] if context else [])
+    forked.context = context
+    return forked
+
+def _thread_chat(chat: object, local: threading.local) -> object:
+    """
+    Returns the chat of the calling thread, forked from ``chat`` on first use.
+    """
+    if not hasattr(local, 'chat'):
+        local.chat = fork_chat(chat)
+    return local.chat
+
+def generate_q_dataset(question_row: str, chat: object, plan: str = 'free', max_workers: int = 1, journal_path: str = None, batch_size: int = 1)->object:
     """
     Generates a question-answer dataset by processing a DataFrame and generating natural language questions for each row.
 
+    Every distinct question topic is only sent to the chat interface once, even if it appears in several questionnaires, and the generated question is shared by all rows with that topic.
+    Rows without a topic are not sent and get NaN in both new columns.
+
     :param question_row: The name of the column in the DataFrame that contains question topics.
     :type question_row: str
     :param chat: An object representing the chat interface. It must have a `send_message` method to generate questions based on provided topics.
     :type chat: object
+    :param plan: The subscription plan of the user, used to determine rate-limiting logic when interacting with the chat interface.
+    :type plan: str
+    :param max_workers: The number of requests kept in flight at once, see :py:func:`data_gen.generate_concurrent`.
+    :type max_workers: int
+    :param journal_path: Optional path to a :py:class:`data_gen.GenerationJournal`. Finished questions are written to it and skipped when the function is run again.
+    :type journal_path: str or None
+    :param batch_size: The number of questions packed into one request, see :py:func:`data_gen.generate_batched`.
+    :type batch_size: int
     :return: A pandas DataFrame with the following modifications:
     
                  - A new column, 'question_ft', containing the generated or processed questions for each row.
@@ -105,10 +239,9 @@ def generate_q_dataset(question_row: str, chat: object)->object:
     """
     df_qa = generate_data(path_list)
     df_qa.reset_index(drop=True, inplace=True) #drop the index of the questionnaires
-    max_len = len(df_qa.index)
-    i = 0
-    while i < max_len:
-        question = df_qa[question_row].iloc[i]
+    topic_ids, topics = pd.factorize(df_qa[question_row]) #only generate a single question per distinct topic
+    prompts = []
+    for question in topics:
         instruction_q = f"""\nThe followoing is the question topic for generation: {question};
         To generate the question, write a natural question regarding '{question}'. \n
         Keep a human tone to simulate the situation of a questionnaire. Output the question as plain text.
@@ -116,18 +249,15 @@ def generate_q_dataset(question_row: str, chat: object)->object:
         not to alter the semantic meaning of answers in the slightest and try to keep the wording as is.
         Examples: Question topic: 'What kind of follow up is planned' Generated Question: 'What kind of follow up is planned?'
         Question topic: 'What is the size of your business unit' Generated Question: 'What is the size of your business unit?'"""
-        question_str, response = generate_with_msg(f"{instruction_q.format(question=question)}", chat) #generate response
-        while i + 1 < len(df_qa.index) and df_qa[question_row].iloc[i+1]==df_qa[question_row].iloc[i]: #only generate a single question for multiple options
-          df_qa.loc[i, 'question_ft'] = response
-          df_qa.loc[i, 'prompts_q'] = question_str
-          i+=1
-        df_qa.loc[i, 'prompts_q'] = question_str
-        df_qa.loc[i, 'question_ft'] = response
-        print(response)
-        i+=1
+        prompts.append(instruction_q.format(question=question))
+    with collector.stage('generate.questions', items=len(prompts)):
+        results = generate_resumable(prompts, chat, plan, max_workers, journal_path, batch_size)
+    prompts_q, question_ft = zip(*results) if results else ((), ())
+    df_qa['prompts_q'] = np.append(np.asarray(prompts_q, dtype=object), np.nan)[topic_ids] #broadcast the generated questions back to all rows, a missing topic (code -1) gets NaN
+    df_qa['question_ft'] = np.append(np.asarray(question_ft, dtype=object), np.nan)[topic_ids]
     return df_qa
 
-def generate_answers(df_qa: object, answer_row: str, question_row: str, type_row: str, chat: object, plan: str)->object:
+def generate_answers(df_qa: object, answer_row: str, question_row: str, type_row: str, chat: object, plan: str, max_workers: int = 1, journal_path: str = None, one_per_group: bool = False, batch_size: int = 1, by_questionnaire: bool = False)->object:
     """
     Generates refined answers for a question-answer DataFrame by processing each row and interacting with a chat interface.
 
@@ -143,6 +273,17 @@ def generate_answers(df_qa: object, answer_row: str, question_row: str, type_row
     :type chat: object
     :param plan: The subscription plan of the user, used to determine rate-limiting logic when interacting with the chat interface.
     :type plan: str
+    :param max_workers: The number of requests kept in flight at once, see :py:func:`data_gen.generate_concurrent`.
+    :type max_workers: int
+    :param journal_path: Optional path to a :py:class:`data_gen.GenerationJournal`. Finished rows are written to it and skipped when the function is run again.
+    :type journal_path: str or None
+    :param one_per_group: If True, a MULTI_SELECT question gets a single request with all of its options, and every row of the question shares the generated answer.
+                          Otherwise, each row gets its own request with the options from that row to the end of the question, see :py:func:`data_gen.group_options`.
+    :type one_per_group: bool
+    :param batch_size: The number of rows packed into one request, see :py:func:`data_gen.generate_batched`.
+    :type batch_size: int
+    :param by_questionnaire: If True, the options of a question are not joined across two questionnaires, see :py:func:`data_gen.group_options`.
+    :type by_questionnaire: bool
     :return: A pandas DataFrame with the following new columns:
     
                  - 'prompts_a': The instruction prompts used to generate refined answers.
@@ -150,30 +291,644 @@ def generate_answers(df_qa: object, answer_row: str, question_row: str, type_row
                  - 'option': The concatenated or individual answer(s) processed from the input DataFrame.
     :rtype: pandas.DataFrame
     """
-    max_len = len(df_qa.index)
-    i = 0
-    while i < max_len:
-        question = df_qa[question_row].iloc[i]
-        answer = df_qa[answer_row].iloc[i]
-        if df_qa[type_row].iloc[i] == 'MULTI_SELECT':
-          question = df_qa[question_row].iloc[i]
-          j = i #temp storage for i
-          while j + 1 < len(df_qa.index) and df_qa[question_row].iloc[j] == df_qa[question_row].iloc[j + 1]:
-            answer += ', ' + df_qa[answer_row].iloc[j + 1]
-            j += 1
-        else:
-          question = df_qa[question_row].iloc[i]
-          answer = df_qa[answer_row].iloc[i]
-        instruction_a = instructions.get(df_qa['type'].iloc[i]) #get corresponding instruction field
-        question_str, response = generate_with_msg(f"{instruction_a.format(question=question, answer=answer)}", chat, plan) #generate response
-        df_qa.loc[i, 'prompts_a'] = question_str
-        df_qa.loc[i, 'answers_ft'] = response
-        df_qa.loc[i, 'option'] = answer
-        i+=1
-        if i%10 == 0:
-          print("iteration ", i)
+    options, group_ids = group_options(df_qa, answer_row, question_row, type_row, one_per_group, by_questionnaire)
+    instruction_a = df_qa[type_row].map(instructions) #get corresponding instruction field
+    prompts = [instruction.format(question=question, answer=answer)
+               for instruction, question, answer in zip(instruction_a, df_qa[question_row], options)]
+    request_rows = np.arange(len(prompts))
+    if one_per_group:
+        multi = (df_qa[type_row] == 'MULTI_SELECT').to_numpy()
+        first_rows = pd.Series(request_rows).groupby(group_ids).transform('first').to_numpy()
+        request_rows = np.where(multi, first_rows, request_rows) #rows of a MULTI_SELECT question reuse the request of its first row
+    unique_rows, request_ids = np.unique(request_rows, return_inverse=True)
+    with collector.stage('generate.answers', items=len(unique_rows)):
+        results = generate_resumable([prompts[row] for row in unique_rows], chat, plan, max_workers, journal_path, batch_size)
+    df_qa['prompts_a'] = [results[k][0] for k in request_ids] #write all rows back in one step
+    df_qa['answers_ft'] = [results[k][1] for k in request_ids]
+    df_qa['option'] = options.to_list()
     return df_qa
 
+def group_options(df_qa: object, answer_row: str, question_row: str, type_row: str, one_per_group: bool = False, by_questionnaire: bool = False) -> tuple:
+    """
+    Joins the answer options of MULTI_SELECT questions in a single grouped pass over the DataFrame.
+
+    Consecutive rows with the same question form a group, as in the previous row-by-row loop, even if they belong to two questionnaires.
+    For MULTI_SELECT rows, the options of the group are joined with ``', '``; all other rows keep their own option.
+
+    :param df_qa: The input DataFrame containing question-answer data.
+    :type df_qa: pandas.DataFrame
+    :param answer_row: The name of the column in the DataFrame that contains answers.
+    :type answer_row: str
+    :param question_row: The name of the column in the DataFrame that contains questions.
+    :type question_row: str
+    :param type_row: The name of the column in the DataFrame that specifies the type of question.
+    :type type_row: str
+    :param one_per_group: If True, every MULTI_SELECT row gets all options of its group. Otherwise, each row gets the options from that row to the end of its group.
+    :type one_per_group: bool
+    :param by_questionnaire: If True and the DataFrame has a 'questionnaire' column, a new group also starts with every questionnaire, so the options of consecutive questionnaires with the same question are not joined.
+    :type by_questionnaire: bool
+    :return: A tuple containing:
+
+                 - A pandas Series with the option string of each row.
+                 - A numpy array with the group number of each row.
+    :rtype: tuple[pandas.Series, numpy.ndarray]
+    """
+    keys = [df_qa[question_row]]
+    if by_questionnaire and 'questionnaire' in df_qa.columns:
+        keys.append(df_qa['questionnaire'])
+    new_group = np.zeros(len(df_qa.index), dtype=bool)
+    for key in keys:
+        new_group |= (key != key.shift()).to_numpy()
+    group_ids = np.cumsum(new_group) - 1
+    answers = df_qa[answer_row]
+    grouped = answers.astype(str).groupby(group_ids)
+    if one_per_group:
+        joined = grouped.transform(', '.join)
+    else:
+        joined = grouped.transform(lambda group: [', '.join(group.iloc[k:]) for k in range(len(group))])
+    options = answers.where(df_qa[type_row] != 'MULTI_SELECT', joined)
+    return options, group_ids
+
+def generate_concurrent(prompts: list, chat: object, tier: str, max_workers: int = 4, on_result=None) -> list:
+    """
+    Sends a list of prompts through :py:func:`data_gen.generate_with_msg` while keeping up to ``max_workers`` requests in flight at once.
+
+    Results are returned in the order of ``prompts``, no matter in which order the responses arrive.
+    With more than one worker, every worker thread sends its prompts to its own chat from :py:func:`data_gen.fork_chat`, as the chats of the chat interface are not thread-safe.
+
+    :param prompts: The messages to be sent to the chat interface.
+    :type prompts: list of str
+    :param chat: An object representing the chat interface. It must have a `send_message` method, e.g. a chat from :py:func:`data_gen.init_context` or a :py:class:`data_gen.FakeChat`.
+    :type chat: object
+    :param tier: The subscription tier of the user, passed on to :py:func:`data_gen.generate_with_msg`.
+    :type tier: str
+    :param max_workers: The maximum number of concurrent requests. ``1`` sends the prompts one after another to ``chat`` itself.
+    :type max_workers: int
+    :param on_result: Optional function called with the index of the prompt and its ``(prompt, response)`` tuple as soon as a response arrives.
+    :type on_result: callable or None
+    :return: A list of ``(prompt, response)`` tuples, one per prompt and in the same order.
+    :rtype: list[tuple[str, str]]
+    """
+    results = [None] * len(prompts)
+    local = threading.local()
+    worker_chat = (lambda: chat) if max_workers <= 1 else (lambda: _thread_chat(chat, local)) #one chat per worker thread
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(lambda prompt: generate_with_msg(prompt, worker_chat(), tier), prompt): i for i, prompt in enumerate(prompts)}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                results[i] = future.result()
+                collector.count('generate.responses')
+                if on_result is not None:
+                  on_result(i, results[i])
+                if done % 10 == 0:
+                  print("iteration ", done)
+        except BaseException:
+            for future in futures:
+                future.cancel() #do not keep sending requests after a failure
+            raise
+    return results
+
+def generate_resumable(prompts: list, chat: object, tier: str, max_workers: int = 1, journal_path: str = None, batch_size: int = 1) -> list:
+    """
+    Same as :py:func:`data_gen.generate_concurrent` (or :py:func:`data_gen.generate_batched` for a ``batch_size`` above 1), but checkpoints every response to a :py:class:`data_gen.GenerationJournal`.
+
+    When the function is run again with the same journal, e.g. after a crash, prompts that already have a response in the journal are not sent again.
+
+    :param prompts: The messages to be sent to the chat interface.
+    :type prompts: list of str
+    :param chat: An object representing the chat interface. It must have a `send_message` method.
+    :type chat: object
+    :param tier: The subscription tier of the user, passed on to :py:func:`data_gen.generate_with_msg`.
+    :type tier: str
+    :param max_workers: The maximum number of concurrent requests.
+    :type max_workers: int
+    :param journal_path: The path to the journal file. If None, no checkpoints are written.
+    :type journal_path: str or None
+    :param batch_size: The number of prompts packed into one request.
+    :type batch_size: int
+    :return: A list of ``(prompt, response)`` tuples, one per prompt and in the same order.
+    :rtype: list[tuple[str, str]]
+    """
+    generate = generate_concurrent if batch_size <= 1 else functools.partial(generate_batched, batch_size=batch_size)
+    if journal_path is None:
+        return generate(prompts, chat, tier, max_workers)
+    journal = GenerationJournal(journal_path)
+    try:
+        results = [None] * len(prompts)
+        pending = []
+        for i, prompt in enumerate(prompts):
+            response = journal.get(i, prompt)
+            if response is None:
+                pending.append(i)
+            else:
+                results[i] = (prompt, response)
+        if len(pending) < len(prompts):
+            print(f"Resuming: {len(prompts) - len(pending)} of {len(prompts)} rows are already in the journal")
+            collector.count('generate.journal_hits', len(prompts) - len(pending))
+        fresh = generate([prompts[i] for i in pending], chat, tier, max_workers,
+                         on_result=lambda k, result: journal.write(pending[k], *result))
+        for i, result in zip(pending, fresh):
+            results[i] = result
+    finally:
+        journal.close()
+    return results
+
+BATCH_INSTRUCTION = """The following are {count} independent tasks, numbered from 1 to {count}. Complete each task on its own, as if it was the only one.
+Return the results as a JSON array of exactly {count} strings, where the n-th string is the result of task n. Output nothing but the JSON array.
+"""
+
+def build_batch_prompt(prompts: list) -> str:
+    """
+    Packs several prompts into one message with numbered tasks, asking for a JSON array with one result per task.
+
+    :param prompts: The prompts to be packed into the message.
+    :type prompts: list of str
+    :return: The message to be sent to the chat interface.
+    :rtype: str
+    """
+    tasks = ''.join(f"\nTask {n}:\n{prompt}\n" for n, prompt in enumerate(prompts, 1))
+    return BATCH_INSTRUCTION.format(count=len(prompts)) + tasks
+
+def parse_batch_response(response: str, count: int):
+    """
+    Parses the response to a message from :py:func:`data_gen.build_batch_prompt` into one result per task.
+
+    :param response: The response text from the chat interface.
+    :type response: str
+    :param count: The number of tasks in the message.
+    :type count: int
+    :return: A list with ``count`` results, or None if the response is not a JSON array with one string per task.
+    :rtype: list of str or None
+    """
+    response = re.sub(r"^```(?:json)?\s*|\s*```$", "", response.strip()) #the model sometimes wraps JSON in a code block
+    try:
+        results = json.loads(response[response.index('['):response.rindex(']') + 1])
+    except ValueError:
+        return None
+    if not isinstance(results, list) or len(results) != count or not all(isinstance(result, str) for result in results):
+        return None
+    return [result.strip() for result in results]
+
+def generate_batched(prompts: list, chat: object, tier: str, max_workers: int = 1, on_result=None, batch_size: int = 5) -> list:
+    """
+    Sends a list of prompts with ``batch_size`` prompts packed into each request, see :py:func:`data_gen.build_batch_prompt`.
+
+    If the response to a batch cannot be parsed into one result per prompt, the prompts of that batch are sent again one by one.
+    The batches are sent through :py:func:`data_gen.generate_concurrent`, so up to ``max_workers`` of them are in flight at once.
+
+    :param prompts: The messages to be sent to the chat interface.
+    :type prompts: list of str
+    :param chat: An object representing the chat interface. It must have a `send_message` method.
+    :type chat: object
+    :param tier: The subscription tier of the user, passed on to :py:func:`data_gen.generate_with_msg`.
+    :type tier: str
+    :param max_workers: The maximum number of concurrent requests.
+    :type max_workers: int
+    :param on_result: Optional function called with the index of the prompt and its ``(prompt, response)`` tuple as soon as its response is available.
+    :type on_result: callable or None
+    :param batch_size: The number of prompts packed into one request.
+    :type batch_size: int
+    :return: A list of ``(prompt, response)`` tuples, one per prompt and in the same order. The prompt is the original prompt, not the batch message.
+    :rtype: list[tuple[str, str]]
+    """
+    results = [None] * len(prompts)
+    batches = [list(range(start, min(start + batch_size, len(prompts)))) for start in range(0, len(prompts), batch_size)]
+    failed = []
+
+    def collect_batch(b, result):
+        responses = parse_batch_response(result[1], len(batches[b]))
+        if responses is None:
+            failed.extend(batches[b])
+            return
+        for i, response in zip(batches[b], responses):
+            results[i] = (prompts[i], response)
+            if on_result is not None:
+                on_result(i, results[i])
+
+    def collect_single(k, result):
+        results[failed[k]] = result
+        if on_result is not None:
+            on_result(failed[k], result)
+
+    generate_concurrent([build_batch_prompt([prompts[i] for i in batch]) for batch in batches], chat, tier, max_workers, collect_batch)
+    if failed:
+        print(f"Falling back to single requests for {len(failed)} rows")
+        collector.count('generate.batch_fallbacks', len(failed))
+        failed.sort()
+        generate_concurrent([prompts[i] for i in failed], chat, tier, max_workers, collect_single)
+    return results
+
+def benchmark_batching(prompts: list, batch_sizes: list = (1, 5, 10), chat: object = None, tier: str = 'paid', max_workers: int = 1) -> object:
+    """
+    Compares throughput and quota use of batched prompting against one prompt per request.
+
+    Without a ``chat``, a :py:class:`data_gen.FakeChat` with 0.2 seconds of latency per request answers every batch, so only the request overhead is measured.
+    Disable the prompt cache before benchmarking, as cached prompts are not sent.
+
+    :param prompts: The prompts to be sent.
+    :type prompts: list of str
+    :param batch_sizes: The batch sizes to compare. A batch size of 1 is the one-row-per-request path.
+    :type batch_sizes: list of int
+    :param chat: An object representing the chat interface. Defaults to a :py:class:`data_gen.FakeChat`.
+    :type chat: object or None
+    :param tier: The subscription tier of the user, passed on to :py:func:`data_gen.generate_with_msg`.
+    :type tier: str
+    :param max_workers: The maximum number of concurrent requests.
+    :type max_workers: int
+    :return: A DataFrame with one row per batch size and the columns 'batch_size', 'requests', 'tokens', 'seconds' and 'rows_per_second'.
+    :rtype: pandas.DataFrame
+    """
+    if chat is None:
+        def responder(msg):
+            count = re.match(r"The following are (\d+) independent tasks", msg)
+            return json.dumps([f"Answer {n}" for n in range(int(count.group(1)))]) if count else "Answer"
+        chat = FakeChat(responder, latency=0.2)
+    report = []
+    for batch_size in batch_sizes:
+        metered = _MeteredChat(chat)
+        start = time.perf_counter()
+        generate_resumable(prompts, metered, tier, max_workers, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        report.append({'batch_size': batch_size, 'requests': metered.requests, 'tokens': metered.tokens,
+                       'seconds': seconds, 'rows_per_second': len(prompts) / seconds})
+    return pd.DataFrame(report)
+
+class _MeteredChat:
+    """
+    Wraps a chat object and counts the requests and estimated tokens sent through it.
+    Every thread sends its messages to its own chat from :py:func:`data_gen.fork_chat`, while the counters are shared.
+    """
+
+    def __init__(self, chat: object):
+        self.chat = chat
+        self.requests = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def send_message(self, msg: str) -> list:
+        chunks = list(_thread_chat(self.chat, self._local).send_message(msg))
+        with self._lock:
+            self.requests += 1
+            self.tokens += estimate_tokens(msg) + sum(estimate_tokens(chunk.text) for chunk in chunks)
+        return chunks
+
+class GenerationJournal:
+    """
+    An append-only JSONL journal of finished generation rows, used to resume long generation runs.
+
+    Each line holds the row number, the prompt and the response. A row only counts as finished if its prompt
+    is unchanged, so rows whose prompt was tweaked are generated again. A line cut off by a crash is discarded when the journal is opened.
+
+    :param path: The path to the journal file. It is created if it does not exist.
+    :type path: str
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            if len(complete) < len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(len(complete)) #drop the incomplete last line
+            for line in complete.decode('utf-8').splitlines():
+                record = json.loads(line)
+                self.rows[record['row']] = record
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def get(self, row: int, prompt: str):
+        """
+        Returns the journaled response of a row if it was generated from the same prompt.
+
+        :param row: The row number.
+        :type row: int
+        :param prompt: The prompt of the row in the current run.
+        :type prompt: str
+        :return: The response, or None if the row has not finished yet.
+        :rtype: str or None
+        """
+        record = self.rows.get(row)
+        if record is None or record['prompt'] != prompt:
+            return None
+        return record['response']
+
+    def write(self, row: int, prompt: str, response: str):
+        """
+        Appends a finished row to the journal and flushes it to disk.
+
+        :param row: The row number.
+        :type row: int
+        :param prompt: The prompt of the row.
+        :type prompt: str
+        :param response: The response text from the chat interface.
+        :type response: str
+        """
+        record = {'row': row, 'prompt': prompt, 'response': response}
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.rows[row] = record
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        with self._lock:
+            self._file.close()
+
+class FakeChat:
+    """
+    A local stand-in for the chat objects of the chat interface, e.g. for tests and benchmarks without API calls.
+
+    Like a chat from :py:func:`data_gen.init_context`, its `send_message` method returns an iterable of chunks with a ``text`` attribute.
+    Unlike such a chat, it is thread-safe: every message and response is appended to ``history`` under a lock, in the order the responses are sent.
+
+    :param responder: A function mapping the sent message to the response text. Defaults to echoing the message.
+    :type responder: callable or None
+    :param latency: The number of seconds each request takes, to simulate the round trip to the API.
+    :type latency: float
+    """
+
+    def __init__(self, responder=None, latency: float = 0.0):
+        self.responder = responder if responder is not None else (lambda msg: msg)
+        self.latency = latency
+        self.history = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, msg: str) -> list:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        response = self.responder(msg)
+        with self._lock:
+            self.history += [{"role": "user", "parts": msg}, {"role": "model", "parts": response}]
+        return [SimpleNamespace(text=response)]
+
+TIER_LIMITS = {
+    'free': {'rpm': 15, 'tpm': 1000000},
+    'paid': {'rpm': 2000, 'tpm': 4000000},
+}
+"""Requests and tokens per minute allowed by the API for each subscription tier."""
+
+class RateLimiter:
+    """
+    A thread-safe and asyncio-safe sliding window rate limiter for requests per minute (RPM) and tokens per minute (TPM).
+
+    Every request reserves the earliest point in time at which it fits into the window and waits until then,
+    so requests are spread out right at the limit instead of being sent in bursts followed by a long pause.
+
+    :param rpm: The maximum number of requests within one window.
+    :type rpm: int
+    :param tpm: The maximum number of tokens within one window. ``None`` disables the token limit.
+    :type tpm: int or None
+    :param period: The length of the window in seconds.
+    :type period: float
+    """
+
+    def __init__(self, rpm: int, tpm: int = None, period: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.period = period
+        self.requests = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+        self._window = collections.deque() #(send time, tokens) of the requests within the window
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Reserves a slot for a request with the given number of tokens and returns the seconds to wait before sending it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0][0] <= now - self.period:
+                self._window_tokens -= self._window.popleft()[1]
+            send_at = now
+            if len(self._window) >= self.rpm:
+                send_at = max(send_at, self._window[-self.rpm][0] + self.period)
+            if self.tpm is not None:
+                tokens = min(tokens, self.tpm)
+                excess = self._window_tokens + tokens - self.tpm
+                for sent, sent_tokens in self._window:
+                    if excess <= 0:
+                        break
+                    excess -= sent_tokens
+                    send_at = max(send_at, sent + self.period)
+            self._window.append((send_at, tokens))
+            self._window_tokens += tokens
+            wait = send_at - now
+            self.requests += 1
+            if wait > 0:
+                self.throttled_requests += 1
+                self.throttled_seconds += wait
+            return wait
+
+    def acquire(self, tokens: int = 1) -> float:
+        """
+        Blocks the calling thread until a request with the given number of tokens may be sent.
+
+        :param tokens: The estimated number of tokens of the request.
+        :type tokens: int
+        :return: The number of seconds the request was throttled.
+        :rtype: float
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: int = 1) -> float:
+        """
+        Same as :py:meth:`acquire`, but waits without blocking the event loop.
+
+        :param tokens: The estimated number of tokens of the request.
+        :type tokens: int
+        :return: The number of seconds the request was throttled.
+        :rtype: float
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def metrics(self) -> dict:
+        """
+        Returns the number of requests, how many of them were throttled and the total time spent waiting.
+
+        :return: A dict with the keys 'requests', 'throttled_requests' and 'throttled_seconds'.
+        :rtype: dict
+        """
+        with self._lock:
+            return {'requests': self.requests, 'throttled_requests': self.throttled_requests, 'throttled_seconds': self.throttled_seconds}
+
+rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(tier: str) -> RateLimiter:
+    """
+    Returns the shared :py:class:`data_gen.RateLimiter` of a subscription tier, configured from ``TIER_LIMITS``.
+
+    :param tier: The subscription tier of the user. Accepted values are 'paid' or any other tier indicating a free account.
+    :type tier: str
+    :return: The rate limiter shared by all requests of that tier.
+    :rtype: RateLimiter
+    """
+    tier = 'paid' if tier == 'paid' else 'free'
+    with _rate_limiters_lock:
+        if tier not in rate_limiters:
+            rate_limiters[tier] = RateLimiter(**TIER_LIMITS[tier])
+            collector.register(f'rate_limiter.{tier}', rate_limiters[tier].metrics)
+        return rate_limiters[tier]
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimates the number of tokens of a text, with about four characters per token.
+
+    :param text: The text to be sent to the chat interface.
+    :type text: str
+    :return: The estimated number of tokens.
+    :rtype: int
+    """
+    return len(text) // 4 + 1
+
+def estimate_request_tokens(chat_msg: str, chat: object) -> int:
+    """
+    Roughly estimates the input tokens of a request, which include the whole chat history, as a chat resends its history with every message.
+
+    :param chat_msg: The message to be sent to the chat interface.
+    :type chat_msg: str
+    :param chat: The chat object the message is sent to. Its ``history`` is a list of dicts or of contents with a ``parts`` entry, as in a chat from :py:func:`data_gen.init_context`.
+    :type chat: object
+    :return: The estimated number of tokens of the history and the message.
+    :rtype: int
+    """
+    tokens = estimate_tokens(chat_msg)
+    for content in getattr(chat, 'history', None) or ():
+        parts = content.get('parts', '') if isinstance(content, dict) else getattr(content, 'parts', '')
+        for part in [parts] if isinstance(parts, str) else parts:
+            tokens += estimate_tokens(part if isinstance(part, str) else getattr(part, 'text', '') or '')
+    return tokens
+
+class PromptCache:
+    """
+    A persistent prompt to response cache, stored in a SQLite file.
+
+    Responses are keyed by a hash of the model id, the context the chat was initialised with and the prompt text,
+    so re-runs only send the prompts that changed. The least recently used entries are evicted once ``max_entries`` is exceeded.
+
+    :param path: The path to the SQLite file. It is created if it does not exist.
+    :type path: str
+    :param max_entries: The maximum number of cached responses.
+    :type max_entries: int
+    """
+
+    def __init__(self, path: str = 'prompt_cache.sqlite', max_entries: int = 1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(chat_msg: str, chat: object) -> str:
+        """
+        Computes the cache key of a message sent to a chat.
+
+        :param chat_msg: The message to be sent to the chat interface.
+        :type chat_msg: str
+        :param chat: The chat object the message is sent to.
+        :type chat: object
+        :return: A SHA-256 hex digest of the model id, the chat context and the message.
+        :rtype: str
+        """
+        model_id = getattr(getattr(chat, 'model', None), 'model_name', '')
+        context = getattr(chat, 'context', '')
+        return hashlib.sha256('\0'.join([model_id, context, chat_msg]).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        Looks up a cached response and counts the hit or miss.
+
+        :param key: The cache key from :py:meth:`key`.
+        :type key: str
+        :return: The cached response, or None if the key is not cached.
+        :rtype: str or None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, response: str):
+        """
+        Stores a response and evicts the least recently used entries if the cache is full.
+
+        :param key: The cache key from :py:meth:`key`.
+        :type key: str
+        :param response: The response text from the chat interface.
+        :type response: str
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is None:
+                self._size += 1
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, time.time()))
+            if self._size > self.max_entries:
+                self._conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (self._size - self.max_entries,))
+                self._size = self.max_entries
+
+    def metrics(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+
+        :return: A dict with the keys 'hits', 'misses', 'hit_rate' and 'entries'.
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': self._size}
+
+    def close(self):
+        """
+        Closes the connection to the SQLite file.
+        """
+        with self._lock:
+            self._conn.close()
+
+prompt_cache = None
+
+def enable_prompt_cache(path: str = 'prompt_cache.sqlite', max_entries: int = 1000000) -> PromptCache:
+    """
+    Enables the :py:class:`data_gen.PromptCache` for all requests sent through :py:func:`data_gen.generate_with_msg`.
+
+    :param path: The path to the SQLite file.
+    :type path: str
+    :param max_entries: The maximum number of cached responses.
+    :type max_entries: int
+    :return: The enabled cache, e.g. to read its metrics.
+    :rtype: PromptCache
+    """
+    global prompt_cache
+    prompt_cache = PromptCache(path, max_entries)
+    collector.register('prompt_cache', prompt_cache.metrics)
+    return prompt_cache
+
 def generate_with_msg(chat_msg: str, chat: object, tier: str) -> tuple[str, str]:
     """
     Generates a response to a given chat message, enforcing rate limits based on the user's subscription tier.
@@ -190,21 +945,20 @@ def generate_with_msg(chat_msg: str, chat: object, tier: str) -> tuple[str, str]
                  - The response text from the chat interface.
     :rtype: tuple[str, str]
     """
-    global req_count
-    req_count += 1
-    if(tier == 'paid'):
-      if req_count >= 1500: #max requests per minute are 15, we use 10 to leave some headspace
-        print("Waiting for 60 seconds...")
-        time.sleep(60)
-        req_count = 0
-    else:
-      if req_count >= 10: #max requests per minute are 15, we use 10 to leave some headspace
-        print("Waiting for 60 seconds...")
-        time.sleep(60)
-        req_count = 0
-    chat_rsp = chat.send_message(f"{chat_msg}")
-    for chunk in chat_rsp:
-        response = chunk.text
+    cache = prompt_cache
+    if cache is not None:
+        key = cache.key(chat_msg, chat)
+        response = cache.get(key)
+        if response is not None:
+            return chat_msg, response
+    wait = get_rate_limiter(tier).acquire(estimate_request_tokens(chat_msg, chat)) #wait for a free slot in the rate limit window, counting the resent history
+    collector.observe('generate.throttle_wait', wait)
+    with collector.stage('generate.request', items=1):
+        chat_rsp = chat.send_message(f"{chat_msg}")
+        for chunk in chat_rsp:
+            response = chunk.text
+    if cache is not None:
+        cache.put(key, response)
     return chat_msg, response
 
 def clean_df(df: object, row: str, prompt: str, pattern: str)->object:
@@ -247,14 +1001,71 @@ def find_index_iter(answer: str, text: str)->list:
     :return: A list of starting indices where the answer string is found within the text.
     :rtype: list
     """
-    answer = re.escape(answer)
-    matches = re.finditer(answer, text)
-    start_indices = [match.start() for match in matches]
-    return start_indices
+    return find_spans([answer], text)[answer]
+
+def find_spans(answers: list, context: str) -> dict:
+    """
+    Finds the starting indices of several answers within a context in one call.
+
+    Each distinct answer is searched once with ``str.find``, with no regular expression compiled per answer.
+    Like :py:func:`data_gen.find_index_iter`, occurrences of the same answer do not overlap.
+
+    :param answers: The substrings to search for within the context.
+    :type answers: list of str
+    :param context: The text in which to search for the answers.
+    :type context: str
+    :return: A dict mapping each answer to the list of its starting indices in the context.
+    :rtype: dict[str, list[int]]
+    """
+    spans = {}
+    for answer in answers:
+        if answer in spans:
+            continue
+        if not answer:
+            spans[answer] = list(range(len(context) + 1)) #an empty answer matches at every position
+            continue
+        indices = []
+        index = context.find(answer)
+        while index != -1:
+            indices.append(index)
+            index = context.find(answer, index + len(answer))
+        spans[answer] = indices
+    return spans
+
+def annotate_row(answer_list: list, context: str, special_handling: list) -> dict:
+    """
+    Annotates a single row with the answer texts and their starting indices within the context.
+
+    :param answer_list: The answers of the row.
+    :type answer_list: list of str
+    :param context: The context in which to search for the answers.
+    :type context: str
+    :param special_handling: The occurrences to use for every answer, e.g. ``[0, 2]`` for the first and third one. If empty, all occurrences are used.
+    :type special_handling: list of int
+    :return: A dict with the lists 'text' and 'answer_start'.
+    :rtype: dict
+    """
+    spans = find_spans(answer_list, context)
+    text = []
+    answer_start = []
+    for answer in answer_list:
+        indices = spans[answer]
+        if len(special_handling) > 0:
+          text.append(answer)
+          for num in special_handling:
+            answer_start.append(indices[num])
+        else:
+          for index in indices:
+            text.append(answer)
+            answer_start.append(index)
+    return {'text': text, 'answer_start': answer_start}
 
-def annotate_ds(df: object, answer_row: str, context_row: str, special_handling_row: str)->object:
+def annotate_ds(df: object, answer_row: str, context_row: str, special_handling_row: str, n_jobs: int = 1, chunk_size: int = 1000)->object:
     """
     Annotates a DataFrame with answer texts and their corresponding start indices within a given context.
+
+    The rows are annotated as plain lists, optionally split into chunks across a process pool, and the `answers` column is assigned once at the end.
+    The result does not depend on ``n_jobs`` or ``chunk_size``.
     
     :param df: The input DataFrame containing rows to annotate.
     :type df: pandas.DataFrame
@@ -264,37 +1075,159 @@ def annotate_ds(df: object, answer_row: str, context_row: str, special_handling_
     :type context_row: str
     :param special_handling_row: The name of the column in the DataFrame specifying special handling instructions (e.g., specific indices to use).
     :type special_handling_row: str
+    :param n_jobs: The number of processes annotating chunks in parallel. ``1`` annotates all rows in the current process.
+    :type n_jobs: int
+    :param chunk_size: The number of rows sent to a process at once.
+    :type chunk_size: int
     :return: A pandas DataFrame with a new column `answers`, where each row contains a list of dictionaries with:
     
                  - 'text': A list of answer texts found in the context.
                  - 'answer_start': A list of starting indices for each answer in the context.
     :rtype: pandas.DataFrame
     """
-    df['answers'] = ''
-    answer_start = []
-    text = []
-    for i in range(len(df.index)):
-        answer_list = df[answer_row].iloc[i]
-        context = df[context_row].iloc[i]
+    rows = list(zip(df[answer_row], df[context_row], df[special_handling_row]))
+    with collector.stage('annotate.spans', items=len(rows)):
+        if n_jobs > 1 and len(rows) > chunk_size:
+            chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                annotations = [annotation for chunk in executor.map(_annotate_chunk, chunks) for annotation in chunk] #map keeps the order of the chunks
+        else:
+            annotations = _annotate_chunk(rows)
+    df['answers'] = pd.Series([[annotation] for annotation in annotations], index=df.index, dtype=object)
+    return df
+
+def _annotate_chunk(rows: list) -> list:
+    """
+    Annotates a chunk of ``(answer_list, context, special_handling)`` tuples with :py:func:`data_gen.annotate_row`.
+    """
+    return [annotate_row(answer_list, context, special_handling) for answer_list, context, special_handling in rows]
+
+def benchmark_annotate(n_rows: int = 200, n_options: int = 40, context_words: int = 4000, seed: int = 42) -> dict:
+    """
+    Compares :py:func:`data_gen.annotate_row` against the previous annotation with one escaped regular expression per answer, on long synthetic contexts with many options.
+
+    :param n_rows: The number of synthetic rows.
+    :type n_rows: int
+    :param n_options: The number of answers searched per row.
+    :type n_options: int
+    :param context_words: The number of words per context.
+    :type context_words: int
+    :param seed: The seed for the synthetic texts.
+    :type seed: int
+    :return: A dict with the seconds taken by both implementations and the speedup.
+    :rtype: dict
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = [''.join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(3000)]
+    rows = []
+    for _ in range(n_rows):
+        context = ' '.join(rng.choice(words, size=context_words))
+        rows.append((list(rng.choice(words, size=n_options)), context))
+    start = time.perf_counter()
+    legacy = []
+    for answer_list, context in rows:
+        text, answer_start = [], []
         for answer in answer_list:
-              indices = find_index_iter(answer, context)
-              if len(df['special_handling'].iloc[i])>0:
+            for match in re.finditer(re.escape(answer), context):
                 text.append(answer)
-                for num in df['special_handling'].iloc[i]:
-                  answer_start.append(indices[num])
-              else:
-                for index in indices:
-                  text.append(answer)
-                  answer_start.append(index)
-        df.loc[i, 'answers'] = [{'text': text, 'answer_start': answer_start}]
-        answer_start = []
-        text = []
-    return df
+                answer_start.append(match.start())
+        legacy.append({'text': text, 'answer_start': answer_start})
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    annotations = [annotate_row(answer_list, context, []) for answer_list, context in rows]
+    seconds = time.perf_counter() - start
+    assert legacy == annotations
+    return {'rows': n_rows, 'options': n_options, 'regex_seconds': legacy_seconds, 'span_index_seconds': seconds, 'speedup': legacy_seconds / seconds}
+
+def to_answer_dict(value):
+    """
+    Converts a value of an answers column into a single dict with the keys 'text' and 'answer_start'.
+
+    Accepts the list with a single dict written by :py:func:`data_gen.annotate_ds`, the plain dict after :py:func:`data_gen.expand_answers`,
+    as well as both of them stringified, e.g. after a round trip through CSV. A stringified value is parsed as JSON if possible, else as a python repr, in which numpy scalars such as ``np.int64(5)`` are read as plain numbers.
+
+    :param value: A value of an answers column.
+    :type value: str, list, dict or None
+    :return: A dict with the lists 'text' and 'answer_start', or None for empty values.
+    :rtype: dict or None
+    """
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        parsed = None
+        if '"' not in value and '\\' not in value:
+            try:
+                parsed = json.loads(value.replace("'", '"')) #without quotes or escapes inside the strings, the python repr only differs from JSON in the quote character
+            except ValueError: #e.g. None, True or np.int64(...) in the repr
+                pass
+        if parsed is None:
+            try:
+                parsed = json.loads(value)
+            except ValueError:
+                try:
+                    parsed = ast.literal_eval(value)  # Convert the python repr of a list of dictionaries, e.g. from a CSV
+                except ValueError:
+                    parsed = ast.literal_eval(re.sub(r"np\.(?:u?int|float)\d*\(([^()]*)\)", r"\1", value)) #numpy scalars, e.g. np.int64(5), are printed as calls
+        value = parsed
+    if isinstance(value, list):
+        value = value[0] if len(value) > 0 else None  # Since the list contains one dictionary
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    return {'text': list(value['text']), 'answer_start': [int(start) for start in value['answer_start']]}
+
+def save_dataset(df: object, path: str, answer_col: str = 'answers', row_group_size: int = 65536):
+    """
+    Saves a generated or annotated dataset to a Parquet file, with a nested schema for the answers column.
+
+    The answers column is stored as a struct of a 'text' string list and an 'answer_start' integer list, so it can be loaded again without any parsing.
+
+    :param df: The DataFrame to be saved.
+    :type df: pandas.DataFrame
+    :param path: The path of the Parquet file.
+    :type path: str
+    :param answer_col: The name of the answers column. It may hold any of the formats accepted by :py:func:`data_gen.to_answer_dict`. Skipped if the DataFrame has no such column.
+    :type answer_col: str
+    :param row_group_size: The maximum number of rows per row group of the Parquet file.
+    :type row_group_size: int
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    answers_type = pa.struct([('text', pa.list_(pa.string())), ('answer_start', pa.list_(pa.int64()))])
+    if answer_col not in df.columns:
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, row_group_size=row_group_size)
+        return
+    table = pa.Table.from_pandas(df.drop(columns=[answer_col]), preserve_index=False)
+    answers = pa.array([to_answer_dict(value) for value in df[answer_col]], type=answers_type)
+    table = table.add_column(list(df.columns).index(answer_col), answer_col, answers) #keep the original column order
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+def read_dataset(path: str, columns: list = None, memory_map: bool = True, as_table: bool = False) -> object:
+    """
+    Loads a dataset saved by :py:func:`data_gen.save_dataset`.
+
+    :param path: The path of the Parquet file.
+    :type path: str
+    :param columns: Only these columns are read from the file. Defaults to all columns.
+    :type columns: list of str or None
+    :param memory_map: If True, the file is memory-mapped instead of read into memory.
+    :type memory_map: bool
+    :param as_table: If True, the ``pyarrow.Table`` is returned as is, e.g. for ``datasets.Dataset(table)``.
+    :type as_table: bool
+    :return: The dataset, with the answers column as dicts of 'text' and 'answer_start'.
+    :rtype: pandas.DataFrame or pyarrow.Table
+    """
+    import pyarrow.parquet as pq
+    table = pq.read_table(path, columns=columns, memory_map=memory_map)
+    return table if as_table else table.to_pandas()
 
 def expand_answers(df, answer_col):
     """
     Expands rows of a DataFrame where the answer column contains a stringified list of dictionaries.
     Converts the string into a list, then expands the dictionary within it.
+    Columns that are already structured, e.g. loaded with :py:func:`data_gen.read_dataset`, are used without parsing.
+
+    Every value is parsed once with :py:func:`data_gen.to_answer_dict`, then all rows are repeated in a single vectorized step.
     
     
     :param df: A dataframe containing annotated rows with multiple answers for postprocessing
@@ -304,6 +1237,18 @@ def expand_answers(df, answer_col):
     :return: Expanded dataframe, each row has only one single individual answer to a given question
     :rtype: pandas.DataFrame
     """
+    answers = [to_answer_dict(value) for value in df[answer_col]]
+    counts = [min(len(answer['text']), len(answer['answer_start'])) if answer else 0 for answer in answers]
+    expanded = df.iloc[np.repeat(np.arange(len(df.index)), counts)].copy()
+    expanded[answer_col] = [{"text": [text], "answer_start": [start]}
+                            for answer in answers if answer
+                            for text, start in zip(answer['text'], answer['answer_start'])]
+    return expanded
+
+def _expand_answers_iterrows(df, answer_col):
+    """
+    The previous row-by-row implementation of :py:func:`data_gen.expand_answers`, kept as the baseline for :py:func:`data_gen.benchmark_expand_answers`.
+    """
     expanded_rows = []
 
     for _, row in df.iterrows():
@@ -319,13 +1264,47 @@ def expand_answers(df, answer_col):
             new_row[answer_col] = {"text": [text], "answer_start": [start]}
             expanded_rows.append(new_row)
 
-    return object(expanded_rows)
+    return pd.DataFrame(expanded_rows)
+
+def benchmark_expand_answers(n_rows: int = 20000, answers_per_row: int = 3, seed: int = 42) -> dict:
+    """
+    Compares :py:func:`data_gen.expand_answers` against the previous ``iterrows`` implementation on synthetic data with stringified answers, as read from a CSV.
+
+    :param n_rows: The number of rows of the synthetic DataFrame.
+    :type n_rows: int
+    :param answers_per_row: The maximum number of answers per row. Each row gets between 1 and this many answers.
+    :type answers_per_row: int
+    :param seed: The seed for the random number of answers per row.
+    :type seed: int
+    :return: A dict with the number of input and expanded rows, the seconds taken by both implementations and the speedup.
+    :rtype: dict
+    """
+    rng = np.random.default_rng(seed)
+    answers = []
+    for n in rng.integers(1, answers_per_row + 1, size=n_rows):
+        answers.append(str([{'text': [f"answer {k}" for k in range(n)], 'answer_start': [10 * k for k in range(n)]}]))
+    df = pd.DataFrame({'questionnaire': rng.integers(1, 6, size=n_rows),
+                       'question': [f"question {i}" for i in range(n_rows)],
+                       'context': [f"context {i} " * 20 for i in range(n_rows)],
+                       'answers': answers})
+    start = time.perf_counter()
+    legacy = _expand_answers_iterrows(df, 'answers')
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    expanded = expand_answers(df, 'answers')
+    seconds = time.perf_counter() - start
+    assert legacy['answers'].tolist() == expanded['answers'].tolist()
+    return {'rows': n_rows, 'expanded_rows': len(expanded.index), 'iterrows_seconds': legacy_seconds,
+            'vectorized_seconds': seconds, 'speedup': legacy_seconds / seconds}
 
 
 def rank_answers(df):
     """
     Ranks answers based on their scores for each row in a DataFrame and adds the ranked answers and scores as new columns.
 
+    All score columns are unpacked into one matrix, and the best model per row is picked with a single ``argmax``, so any number of model columns can be ranked at once.
+    Score and answer columns are paired by the model name after the prefix. Rows where every model failed get no answer and a NaN score.
+
     :param df: A pandas DataFrame containing columns for scores and answers. The score columns should have names containing the substring 'score_', and the answer columns should have names containing the substring 'answers_'.
     :type df: pandas.DataFrame
     :return: A modified DataFrame with two new columns:
@@ -337,26 +1316,40 @@ def rank_answers(df):
     # Identify columns containing scores and answers
     score_cols = [col for col in df.columns if 'score_' in col]
     answer_cols = [col for col in df.columns if 'answers_' in col]
+    answer_by_model = {col.split('answers_', 1)[1]: col for col in answer_cols}
+    answer_cols = [answer_by_model.get(score_col.split('score_', 1)[1], answer_col) for score_col, answer_col in zip(score_cols, answer_cols)]
+    score_cols = score_cols[:len(answer_cols)]
+    if not score_cols:
+        df['ranked_answer'] = None
+        df['ranked_score'] = np.nan
+        return df
+
+    scores = np.empty((len(df.index), len(score_cols)))
+    for k, score_col in enumerate(score_cols):
+        scores[:, k] = [_score_value(score) for score in df[score_col]]
+    scores[np.isnan(scores)] = -np.inf #failed rows never win
+    rows = np.arange(len(df.index))
+    best = scores.argmax(axis=1)
+    best_scores = scores[rows, best]
+    found = np.isfinite(best_scores)
+    answers = df[answer_cols].to_numpy(dtype=object)
 
-    ranked_answers = []
-    ranked_scores = []
-    for index, row in df.iterrows():
-        best_score = -1  # Initialize with a value lower than any possible score
-        best_answer = None
-        for score_col, answer_col in zip(score_cols, answer_cols):
-            score = row[score_col]
-            if score:
-              score_value = score['score']
-              if score_value > best_score:
-                  best_score = score_value
-                  best_answer = row[answer_col]
-        ranked_answers.append(best_answer)
-        ranked_scores.append(score_value if score_value > best_score else best_score)
-
-    df['ranked_answer'] = ranked_answers
-    df['ranked_score'] = ranked_scores
+    df['ranked_answer'] = np.where(found, answers[rows, best], None)
+    df['ranked_score'] = np.where(found, best_scores, np.nan)
     return df
 
+def _score_value(score) -> float:
+    """
+    Returns the confidence of a score cell, which holds a dict with a 'score' key, or NaN if the model failed on the row.
+    """
+    if isinstance(score, str):
+        score = ast.literal_eval(score) if score.strip() else None #stringified dict, e.g. after a round trip through CSV
+    if isinstance(score, dict):
+        return float(score['score'])
+    if isinstance(score, (int, float)) and not isinstance(score, bool):
+        return float(score)
+    return np.nan
+
 def search_squares(df, row):   
   """
   Searches for square brackets in a specified column of a DataFrame and counts the occurrences.
@@ -4,7 +4,25 @@ ft_an - The module for fine-tuning models on the manually annotated dataset.
 
 __version__ = "0.1.0"
 
-def preprocess_training_examples(examples):
+import ast
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import operator
+import os
+import platform
+import re
+import shutil
+import string
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from telemetry import collector
+
+def preprocess_training_examples(examples, padding="max_length"):
     """
     Direct source of this function: https://huggingface.co/learn/nlp-course/chapter7/7#fine-tuning-the-model-with-the-trainer-api
     
@@ -18,11 +36,14 @@ def preprocess_training_examples(examples):
                               - "text": A list of answer texts.
                               - "answer_start": A list of starting character indices for each answer.
     :type examples: dict
+    :param padding: The padding strategy of the tokenizer. With ``False``, the features are stored unpadded and padded per batch by a data collator, see :ref:`Dynamic Padding`.
+    :type padding: str or bool
     :return: A dictionary of tokenized inputs with the following keys:
     
                  - Tokenized data (e.g., "input_ids", "attention_mask", etc.) as generated by the tokenizer.
                  - "start_positions": A list of token start indices for answers.
                  - "end_positions": A list of token end indices for answers.
+                 - "length": The number of tokens of each feature without padding, unless ``padding="max_length"``.
     :rtype: dict
     """
   
@@ -35,12 +56,63 @@ def preprocess_training_examples(examples):
         stride=stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
-        padding="max_length",
+        padding=padding,
     )
 
     offset_mapping = inputs.pop("offset_mapping")
     sample_map = inputs.pop("overflow_to_sample_mapping")
-    answers = examples["answers"]
+    start_positions, end_positions = answer_positions(inputs, offset_mapping, sample_map, examples["answers"])
+
+    inputs["start_positions"] = start_positions
+    inputs["end_positions"] = end_positions
+    if padding != "max_length":
+        inputs["length"] = [sum(mask) for mask in inputs["attention_mask"]]
+    return inputs
+
+def answer_positions(inputs, offset_mapping, sample_map, answers) -> tuple:
+    """
+    Labels the start and end token positions of the answer of every tokenized feature.
+
+    The features are still labeled one by one: only the answer start and end characters are gathered for the whole batch at once with NumPy.
+    Within each feature, the context bounds are found with ``list.index`` on its sequence ids, and since the offsets inside a context are sorted, the start and end token are found by a binary search (``bisect``) over that feature's offsets instead of walking the context token by token. Features whose answer is not fully inside the context keep the (0, 0) label.
+    The result is identical to the loop of the `NLP Course <https://huggingface.co/learn/nlp-course/chapter7/7>`_, see :py:func:`ft_an.benchmark_answer_positions`.
+
+    :param inputs: The tokenizer output, used for the sequence ids of each feature.
+    :type inputs: transformers.BatchEncoding
+    :param offset_mapping: The character offsets of the tokens of each feature.
+    :type offset_mapping: list
+    :param sample_map: The index of the example of each feature.
+    :type sample_map: list of int
+    :param answers: The answers of the examples, dicts with "text" and "answer_start" lists.
+    :type answers: list of dict
+    :return: The start and end token positions of each feature, (0, 0) if the answer is not fully inside the feature's context.
+    :rtype: tuple of list of int
+    """
+    sample_map = np.asarray(sample_map, dtype=np.int64)
+    start_chars = np.array([answer["answer_start"][0] for answer in answers], dtype=np.int64)
+    end_chars = (start_chars + np.array([len(answer["text"][0]) for answer in answers], dtype=np.int64))[sample_map].tolist()
+    start_chars = start_chars[sample_map].tolist()
+    start_positions = [0] * len(offset_mapping)
+    end_positions = [0] * len(offset_mapping)
+
+    for i, offset in enumerate(offset_mapping):
+        sequence_ids = inputs.sequence_ids(i)
+        context_start = sequence_ids.index(1)
+        try:
+            context_end = sequence_ids.index(None, context_start) - 1 #the context ends before the next special token
+        except ValueError:
+            context_end = len(sequence_ids) - 1
+        # If the answer is not fully inside the context, label is (0, 0)
+        if offset[context_start][0] > start_chars[i] or offset[context_end][1] < end_chars[i]:
+            continue
+        start_positions[i] = bisect.bisect_right(offset, start_chars[i], context_start, context_end + 1, key=operator.itemgetter(0)) - 1
+        end_positions[i] = bisect.bisect_left(offset, end_chars[i], context_start, context_end + 1, key=operator.itemgetter(1))
+    return start_positions, end_positions
+
+def _answer_positions_loop(inputs, offset_mapping, sample_map, answers) -> tuple:
+    """
+    The previous token-by-token implementation of :py:func:`ft_an.answer_positions`, kept as a baseline for :py:func:`ft_an.benchmark_answer_positions`.
+    """
     start_positions = []
     end_positions = []
 
@@ -76,11 +148,56 @@ def preprocess_training_examples(examples):
                 idx -= 1
             end_positions.append(idx + 1)
 
-    inputs["start_positions"] = start_positions
-    inputs["end_positions"] = end_positions
-    return inputs
+    return start_positions, end_positions
 
-def preprocess_validation_examples(examples):
+def benchmark_answer_positions(n_examples: int = 2000, context_words: int = 300, seed: int = 42) -> dict:
+    """
+    Compares :py:func:`ft_an.answer_positions` against the previous loop on synthetic examples, tokenized with the global ``tokenizer``, ``max_length`` and ``stride``.
+
+    :param n_examples: The number of synthetic examples.
+    :type n_examples: int
+    :param context_words: The number of words of each context. Contexts longer than ``max_length`` tokens are split into several features.
+    :type context_words: int
+    :param seed: The seed for the random contexts and answers.
+    :type seed: int
+    :return: A dict with the number of examples and features, the seconds taken by both implementations and the speedup.
+    :rtype: dict
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array("our company has employees in sales marketing and research we plan to use cloud software next year".split())
+    contexts = []
+    answers = []
+    for _ in range(n_examples):
+        context_tokens = rng.choice(words, size=context_words)
+        first = int(rng.integers(context_words))
+        last = min(context_words, first + int(rng.integers(1, 4)))
+        answer_start = len(" ".join(context_tokens[:first])) + (first > 0)
+        contexts.append(" ".join(context_tokens))
+        answers.append({"text": [" ".join(context_tokens[first:last])], "answer_start": [answer_start]})
+    inputs = tokenizer(
+        ["What does the company plan?"] * n_examples,
+        contexts,
+        max_length=max_length,
+        truncation="only_second",
+        stride=stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        padding="max_length",
+    )
+    offset_mapping = inputs["offset_mapping"]
+    sample_map = inputs["overflow_to_sample_mapping"]
+
+    start = time.perf_counter()
+    legacy = _answer_positions_loop(inputs, offset_mapping, sample_map, answers)
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    positions = answer_positions(inputs, offset_mapping, sample_map, answers)
+    seconds = time.perf_counter() - start
+    assert legacy == positions
+    return {'examples': n_examples, 'features': len(offset_mapping), 'loop_seconds': legacy_seconds,
+            'binary_search_seconds': seconds, 'speedup': legacy_seconds / seconds}
+
+def preprocess_validation_examples(examples, indices=None, padding="max_length", compact_offsets=False):
     """
     Direct source of this function: https://huggingface.co/learn/nlp-course/chapter7/7#fine-tuning-the-model-with-the-trainer-api
     
@@ -92,11 +209,20 @@ def preprocess_validation_examples(examples):
                          - "context": A list of corresponding context passages.
                          - "id": A list of unique identifiers for each example.
     :type examples: dict
+    :param indices: The positions of the examples in the dataset, passed by ``map(..., with_indices=True)``.
+    :type indices: list of int or None
+    :param padding: The padding strategy of the tokenizer. With ``False``, the features are stored unpadded and padded per batch by a data collator, see :ref:`Dynamic Padding`.
+    :type padding: str or bool
+    :param compact_offsets: Whether to store the offsets as int32 arrays with a separate context mask instead of lists with `None` for non-context tokens, see :py:func:`ft_an.compact_offset_mapping`.
+    :type compact_offsets: bool
     :return: A dictionary of tokenized inputs with the following keys:
     
                  - Tokenized data (e.g., "input_ids", "attention_mask", etc.) as generated by the tokenizer.
-                 - "offset_mapping": A list of character-to-token offset mappings, with `None` for non-context tokens.
+                 - "offset_mapping": A list of character-to-token offset mappings, with `None` for non-context tokens. With ``compact_offsets``, an int32 array with (0, 0) for non-context tokens.
+                 - "context_mask": With ``compact_offsets``, a boolean array that is True for the context tokens.
                  - "example_id": A list of unique example IDs mapped to the tokenized inputs.
+                 - "example_idx": With ``indices``, the position of the example of each feature in the dataset.
+                 - "length": The number of tokens of each feature without padding, unless ``padding="max_length"``.
     :rtype: dict
     """
   
@@ -109,10 +235,19 @@ def preprocess_validation_examples(examples):
         stride=stride,
         return_overflowing_tokens=True,
         return_offsets_mapping=True,
-        padding="max_length",
+        padding=padding,
     )
 
     sample_map = inputs.pop("overflow_to_sample_mapping")
+    if indices is not None:
+        inputs["example_idx"] = np.asarray(indices, dtype=np.int64)[np.asarray(sample_map, dtype=np.int64)]
+    if compact_offsets:
+        inputs["offset_mapping"], inputs["context_mask"] = compact_offset_mapping(inputs, stack=padding == "max_length")
+        inputs["example_id"] = [examples["id"][sample_idx] for sample_idx in sample_map]
+        if padding != "max_length":
+            inputs["length"] = [sum(mask) for mask in inputs["attention_mask"]]
+        return inputs
+
     example_ids = []
 
     for i in range(len(inputs["input_ids"])):
@@ -126,13 +261,40 @@ def preprocess_validation_examples(examples):
         ]
 
     inputs["example_id"] = example_ids
+    if padding != "max_length":
+        inputs["length"] = [sum(mask) for mask in inputs["attention_mask"]]
     return inputs
 
+def compact_offset_mapping(inputs, stack: bool = True) -> tuple:
+    """
+    Converts the offset mappings of tokenized features into int32 arrays and boolean context masks.
+
+    Compared to lists of tuples with `None` for the question and special tokens, the arrays take a fraction of the memory, and :py:func:`ft_an.decode_predictions` reads the answer offsets directly from them.
+
+    :param inputs: The tokenizer output with "offset_mapping".
+    :type inputs: transformers.BatchEncoding
+    :param stack: Whether to stack the features into single arrays, which requires features of equal length, e.g. with ``padding="max_length"``.
+    :type stack: bool
+    :return: A tuple containing:
+
+             - The offsets of each feature with the shape (n_tokens, 2), (0, 0) for non-context tokens. Stacked, one array with the shape (n_features, max_length, 2).
+             - The context mask of each feature, True for the context tokens.
+    :rtype: tuple
+    """
+    offsets = [np.array(offset, dtype=np.int32).reshape(-1, 2) for offset in inputs["offset_mapping"]]
+    context_masks = [np.array(inputs.sequence_ids(i), dtype=float) == 1 for i in range(len(offsets))] #None becomes NaN
+    for offset, context_mask in zip(offsets, context_masks):
+        offset[~context_mask] = 0
+    if stack and offsets:
+        return np.stack(offsets), np.stack(context_masks)
+    return offsets, context_masks
+
 def compute_metrics(start_logits, end_logits, features, examples):
     """
     Direct source of this function: https://huggingface.co/learn/nlp-course/chapter7/7#fine-tuning-the-model-with-the-trainer-api
     
     Computes evaluation metrics for a question-answering model by comparing predicted answers with the ground truth.
+    The predicted answers are decoded with :py:func:`ft_an.decode_predictions`.
 
     :param start_logits: A list or numpy array of start logits for each feature.
     :type start_logits: list or np.ndarray
@@ -153,21 +315,123 @@ def compute_metrics(start_logits, end_logits, features, examples):
     :rtype: dict
     """
   
+    predicted_answers = decode_predictions(start_logits, end_logits, features, examples)
+    theoretical_answers = [{"id": ex["id"], "answers": ex["answers"]} for ex in examples]
+    return metric.compute(predictions=predicted_answers, references=theoretical_answers)
+
+def decode_predictions(start_logits, end_logits, features, examples) -> list:
+    """
+    Decodes the predicted answer of every example from the start and end logits of its features.
+
+    Like the `NLP Course <https://huggingface.co/learn/nlp-course/chapter7/7>`_, the ``n_best`` start and end tokens of a feature are paired, spans outside the context, ending before they start or longer than ``max_answer_length`` are skipped, and the span with the highest sum of logits over all features of an example wins.
+    Instead of sorting the logits and looping over the pairs, the candidates of all features are taken with ``argpartition`` and scored at once by :py:func:`ft_an.best_spans`, and the best feature of every example is picked by sorting the features by example and score.
+
+    :param start_logits: The start logits, one row per feature.
+    :type start_logits: np.ndarray
+    :param end_logits: The end logits, one row per feature.
+    :type end_logits: np.ndarray
+    :param features: The features from :py:func:`ft_an.preprocess_validation_examples` with "example_id" and "offset_mapping". Compact features with a "context_mask" are read as arrays, and their "example_idx", if present, is used instead of looking up the "example_id".
+    :type features: datasets.Dataset or list of dict
+    :param examples: The examples with "id" and "context", in the order they were preprocessed in.
+    :type examples: datasets.Dataset or list of dict
+    :return: A dict with the 'id' and the 'prediction_text' of every example, an empty text if no valid span was found.
+    :rtype: list of dict
+    """
+    example_ids = _column(examples, "id")
+    contexts = _column(examples, "context")
+    scores, char_starts, char_ends = feature_spans(start_logits, end_logits, features)
+
+    example_index = {}
+    for k, example_id in enumerate(example_ids):
+        example_index.setdefault(example_id, k)
+    feature_examples = _feature_examples(features, example_index)
+    order = np.lexsort((-scores, feature_examples)) #best feature first within each example
+    best_examples, first = np.unique(feature_examples[order], return_index=True)
+    prediction_texts = {}
+    for k, feature_index in zip(best_examples.tolist(), order[first].tolist()):
+        if k >= 0 and np.isfinite(scores[feature_index]):
+            prediction_texts[k] = contexts[k][char_starts[feature_index]:char_ends[feature_index]]
+    return [{"id": example_id, "prediction_text": prediction_texts.get(example_index[example_id], "")} for example_id in example_ids]
+
+def feature_spans(start_logits, end_logits, features) -> tuple:
+    """
+    Finds the best answer span of every feature and returns its score and character positions in the context.
+
+    Spans are scored and masked as in :py:func:`ft_an.decode_predictions`, with the global ``n_best`` and ``max_answer_length``.
+
+    :param start_logits: The start logits, one row per feature.
+    :type start_logits: np.ndarray
+    :param end_logits: The end logits, one row per feature.
+    :type end_logits: np.ndarray
+    :param features: The features from :py:func:`ft_an.preprocess_validation_examples`, with offset lists or compact offsets.
+    :type features: datasets.Dataset or list of dict
+    :return: A tuple containing:
+
+             - The sum of the start and end logit of the best span of each feature, -inf if the feature has no valid span.
+             - The start character of the best span of each feature in the context.
+             - The end character of the best span of each feature in the context.
+    :rtype: tuple of np.ndarray
+    """
+    start_logits = np.asarray(start_logits)
+    end_logits = np.asarray(end_logits)
+    compact = _has_column(features, "context_mask")
+    if compact: #int32 offsets and context masks from compact_offset_mapping
+        offsets, lengths = _padded_column(features, "offset_mapping", start_logits.shape[1])
+        context_mask = _padded_column(features, "context_mask", start_logits.shape[1])[0].astype(bool)
+    else:
+        offset_mapping = _column(features, "offset_mapping")
+        lengths = np.array([len(offsets) for offsets in offset_mapping], dtype=np.int64)
+    start_logits = start_logits[:len(lengths)]
+    end_logits = end_logits[:len(lengths)]
+
+    # With dynamic padding, the logits are padded to the longest feature of the evaluation
+    in_feature = np.arange(start_logits.shape[1]) < lengths[:, None]
+    start_logits = np.where(in_feature, start_logits, -np.inf)
+    end_logits = np.where(in_feature, end_logits, -np.inf)
+
+    candidates = (top_candidates(start_logits, n_best), top_candidates(end_logits, n_best))
+    if not compact: #only the candidate tokens are looked up in the offsets
+        context_mask = np.zeros(start_logits.shape, dtype=bool)
+        for i, (offsets, tokens) in enumerate(zip(offset_mapping, np.concatenate(candidates, axis=1).tolist())):
+            context_mask[i, tokens] = [token < len(offsets) and offsets[token] is not None for token in tokens]
+    starts, ends, scores = best_spans(start_logits, end_logits, context_mask, max_answer_length, n_best, candidates)
+
+    if compact:
+        rows = np.arange(len(lengths))
+        return scores, offsets[rows, starts, 0], offsets[rows, ends, 1]
+    found = np.isfinite(scores)
+    char_starts = np.array([offset_mapping[i][start][0] if valid else 0 for i, (start, valid) in enumerate(zip(starts.tolist(), found.tolist()))], dtype=np.int64)
+    char_ends = np.array([offset_mapping[i][end][1] if valid else 0 for i, (end, valid) in enumerate(zip(ends.tolist(), found.tolist()))], dtype=np.int64)
+    return scores, char_starts, char_ends
+
+def _feature_examples(features, example_index: dict):
+    """
+    Returns the position of the example of every feature, from "example_idx" if present or else by looking up the "example_id", -1 for unknown ids.
+    """
+    if _has_column(features, "example_idx"):
+        return np.asarray(_column(features, "example_idx"), dtype=np.int64)
+    return np.array([example_index.get(example_id, -1) for example_id in _column(features, "example_id")], dtype=np.int64)
+
+def _decode_predictions_loop(start_logits, end_logits, features, examples) -> list:
+    """
+    The previous implementation of :py:func:`ft_an.decode_predictions`, kept as a baseline for :py:func:`ft_an.benchmark_decode_predictions`.
+    """
     example_to_features = collections.defaultdict(list)
     for idx, feature in enumerate(features):
         example_to_features[feature["example_id"]].append(idx)
 
     predicted_answers = []
-    for example in tqdm(examples):
+    for example in examples:
         example_id = example["id"]
         context = example["context"]
         answers = []
 
         # Loop through all features associated with that example
         for feature_index in example_to_features[example_id]:
-            start_logit = start_logits[feature_index]
-            end_logit = end_logits[feature_index]
             offsets = features[feature_index]["offset_mapping"]
+            # With dynamic padding, the logits are padded to the longest feature of the evaluation
+            start_logit = start_logits[feature_index][:len(offsets)]
+            end_logit = end_logits[feature_index][:len(offsets)]
 
             start_indexes = np.argsort(start_logit)[-1 : -n_best - 1 : -1].tolist()
             end_indexes = np.argsort(end_logit)[-1 : -n_best - 1 : -1].tolist()
@@ -198,13 +462,418 @@ def compute_metrics(start_logits, end_logits, features, examples):
         else:
             predicted_answers.append({"id": example_id, "prediction_text": ""})
 
-    theoretical_answers = [{"id": ex["id"], "answers": ex["answers"]} for ex in examples]
-    return metric.compute(predictions=predicted_answers, references=theoretical_answers)
+    return predicted_answers
+
+def benchmark_decode_predictions(n_examples: int = 2000, features_per_example: int = 2, seq_len: int = 384, seed: int = 42) -> dict:
+    """
+    Compares :py:func:`ft_an.decode_predictions` on features with offset lists and on compact features, see :py:func:`ft_an.compact_offset_mapping`, against the previous loop on random logits, with the global ``n_best`` and ``max_answer_length``.
+
+    :param n_examples: The number of synthetic examples.
+    :type n_examples: int
+    :param features_per_example: The number of features of each example.
+    :type features_per_example: int
+    :param seq_len: The number of tokens of each feature. The first 16 tokens and the last token stand for the question and special tokens.
+    :type seq_len: int
+    :param seed: The seed for the random logits.
+    :type seed: int
+    :return: A dict with the number of examples and features, the seconds taken by the loop and by both kinds of features, and the speedups.
+    :rtype: dict
+    """
+    rng = np.random.default_rng(seed)
+    n_features = n_examples * features_per_example
+    # Like a trained model, the logits peak around an answer of a few tokens
+    answer_starts = rng.integers(16, seq_len - 8, size=(n_features, 1))
+    positions = np.arange(seq_len)
+    start_logits = (rng.normal(size=(n_features, seq_len)) - 0.1 * np.abs(positions - answer_starts)).astype(np.float32)
+    end_logits = (rng.normal(size=(n_features, seq_len)) - 0.1 * np.abs(positions - answer_starts - 3)).astype(np.float32)
+    offsets = [None] * 16 + [(5 * k, 5 * k + 4) for k in range(seq_len - 17)] + [None]
+    examples = [{"id": str(k), "context": "word " * seq_len} for k in range(n_examples)]
+    features = [{"example_id": str(k // features_per_example), "offset_mapping": offsets} for k in range(n_features)]
+    compact_offsets = np.array([offset or (0, 0) for offset in offsets], dtype=np.int32)
+    context_mask = np.array([offset is not None for offset in offsets])
+    compact_features = [{"example_id": str(k // features_per_example), "example_idx": k // features_per_example, "offset_mapping": compact_offsets, "context_mask": context_mask}
+                        for k in range(n_features)]
+
+    start = time.perf_counter()
+    legacy = _decode_predictions_loop(start_logits, end_logits, features, examples)
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    predictions = decode_predictions(start_logits, end_logits, features, examples)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compact_predictions = decode_predictions(start_logits, end_logits, compact_features, examples)
+    compact_seconds = time.perf_counter() - start
+    assert legacy == predictions == compact_predictions
+    return {'examples': n_examples, 'features': n_features, 'loop_seconds': legacy_seconds,
+            'vectorized_seconds': seconds, 'speedup': legacy_seconds / seconds,
+            'compact_seconds': compact_seconds, 'compact_speedup': legacy_seconds / compact_seconds}
+
+class StreamingQAEvaluator:
+    """
+    Accumulates the exact match and F1 score of a question-answering model batch by batch, without keeping the logits of the whole evaluation set in memory.
+
+    Every batch of logits is decoded right away with :py:func:`ft_an.feature_spans`, and only the best span seen so far of the examples still in progress is kept.
+    The features must arrive in the order of their examples, as produced by :py:func:`ft_an.preprocess_validation_examples`. An example is scored as soon as a feature of a later example arrives, so the memory stays flat whatever the size of the evaluation set.
+    The scores follow the official SQuAD v1 evaluation, as the ``squad`` metric of :py:func:`ft_an.compute_metrics`.
+
+    :param examples: The examples containing "id", "context" and "answers".
+    :type examples: datasets.Dataset or list of dict
+    :param keep_predictions: Whether to keep the predicted text of every example in ``predictions``.
+    :type keep_predictions: bool
+    """
+
+    def __init__(self, examples, keep_predictions: bool = False):
+        self.examples = examples
+        self.n_examples = len(examples)
+        self.example_index = None #id -> position, only built for features without "example_idx"
+        self.pending = {} #example -> (score, start character, end character) of its best span so far
+        self.next_example = 0 #the examples before it are scored
+        self.exact_match = 0.0
+        self.f1 = 0.0
+        self.scored = 0
+        self.predictions = [] if keep_predictions else None
+
+    def update(self, start_logits, end_logits, features):
+        """
+        Decodes a batch of logits and scores the examples whose features are complete.
+
+        :param start_logits: The start logits of the batch, one row per feature.
+        :type start_logits: np.ndarray
+        :param end_logits: The end logits of the batch, one row per feature.
+        :type end_logits: np.ndarray
+        :param features: The features of the batch, with offset lists or compact offsets.
+        :type features: datasets.Dataset or list of dict
+        :raises ValueError: If a feature belongs to an example that was already scored.
+        """
+        scores, char_starts, char_ends = feature_spans(start_logits, end_logits, features)
+        if self.example_index is None and not _has_column(features, "example_idx"):
+            self.example_index = {}
+            for k, example_id in enumerate(_column(self.examples, "id")):
+                self.example_index.setdefault(example_id, k)
+        feature_examples = _feature_examples(features, self.example_index)
+        for k, score, char_start, char_end in zip(feature_examples.tolist(), scores.tolist(), char_starts.tolist(), char_ends.tolist()):
+            if k < 0:
+                continue
+            if k < self.next_example:
+                raise ValueError(f"The features of example {k} arrived after the example was scored, the features must be in the order of their examples")
+            self._score(k)
+            if k not in self.pending or score > self.pending[k][0]:
+                self.pending[k] = (score, char_start, char_end)
+
+    def compute(self) -> dict:
+        """
+        Scores the remaining examples and returns the metrics of the whole evaluation set.
+
+        :return: The exact match and F1 score in percent, as returned by the ``squad`` metric.
+        :rtype: dict
+        """
+        self._score(self.n_examples)
+        return {"exact_match": 100 * self.exact_match / max(self.scored, 1), "f1": 100 * self.f1 / max(self.scored, 1)}
+
+    def _score(self, stop: int):
+        """
+        Scores the examples before ``stop`` that are not scored yet.
+        """
+        if stop <= self.next_example:
+            return
+        rows = self.examples[self.next_example:stop]
+        if isinstance(rows, list):
+            contexts, answers = _column(rows, "context"), _column(rows, "answers")
+        else:
+            contexts, answers = rows["context"], rows["answers"]
+        for k, context, answer in zip(range(self.next_example, stop), contexts, answers):
+            score, char_start, char_end = self.pending.pop(k, (-np.inf, 0, 0))
+            prediction = context[char_start:char_end] if np.isfinite(score) else ""
+            if isinstance(answer, str):
+                answer = ast.literal_eval(answer)
+            ground_truths = list(answer["text"]) or [""]
+            self.exact_match += max(_exact_match_score(prediction, ground_truth) for ground_truth in ground_truths)
+            self.f1 += max(_f1_score(prediction, ground_truth) for ground_truth in ground_truths)
+            if self.predictions is not None:
+                self.predictions.append(prediction)
+        self.scored += stop - self.next_example
+        self.next_example = stop
+
+def streaming_evaluate(model, features, examples, batch_size: int = 32, device=None) -> dict:
+    """
+    Evaluates a question-answering model batch by batch with :py:class:`ft_an.StreamingQAEvaluator`.
+
+    The features are padded per batch with the global ``tokenizer``, so they can be preprocessed with ``padding="longest"``.
+
+    :param model: The question-answering model.
+    :type model: transformers.PreTrainedModel
+    :param features: The features from :py:func:`ft_an.preprocess_validation_examples`, in the order of their examples.
+    :type features: datasets.Dataset
+    :param examples: The examples containing "id", "context" and "answers".
+    :type examples: datasets.Dataset or list of dict
+    :param batch_size: The number of features per forward pass.
+    :type batch_size: int
+    :param device: The device to run the model on, e.g. "cuda". Defaults to the device of the model.
+    :type device: str or torch.device or None
+    :return: The exact match and F1 score in percent.
+    :rtype: dict
+    """
+    import torch
+
+    evaluator = StreamingQAEvaluator(examples)
+    input_names = [name for name in tokenizer.model_input_names if name in features.column_names]
+    model.eval()
+    if device is not None:
+        model.to(device)
+    with torch.inference_mode():
+        for start in range(0, len(features), batch_size):
+            batch = features.select(range(start, min(start + batch_size, len(features))))
+            inputs = tokenizer.pad({name: list(batch[name]) for name in input_names}, return_tensors="pt").to(model.device)
+            with collector.stage("evaluate.inference", items=len(batch)):
+                outputs = model(**inputs)
+            evaluator.update(outputs.start_logits.float().cpu().numpy(), outputs.end_logits.float().cpu().numpy(), batch)
+    return evaluator.compute()
+
+def _normalize_answer(text: str) -> str:
+    """
+    Lowercases a text and removes punctuation, articles and extra whitespace, as in the official SQuAD evaluation.
+    """
+    text = "".join(ch for ch in text.lower() if ch not in string.punctuation)
+    return " ".join(re.sub(r"\b(a|an|the)\b", " ", text).split())
+
+def _exact_match_score(prediction: str, ground_truth: str) -> float:
+    """
+    Returns 1.0 if the normalized prediction equals the normalized ground truth, else 0.0.
+    """
+    return float(_normalize_answer(prediction) == _normalize_answer(ground_truth))
+
+def _f1_score(prediction: str, ground_truth: str) -> float:
+    """
+    Returns the token-level F1 score of a prediction against a ground truth.
+    """
+    prediction_tokens = _normalize_answer(prediction).split()
+    ground_truth_tokens = _normalize_answer(ground_truth).split()
+    common = collections.Counter(prediction_tokens) & collections.Counter(ground_truth_tokens)
+    num_same = sum(common.values())
+    if num_same == 0:
+        return 0.0
+    precision = num_same / len(prediction_tokens)
+    recall = num_same / len(ground_truth_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+def _column(rows, name: str) -> list:
+    """
+    Returns a column of a dataset or of a list of dicts.
+    """
+    if isinstance(rows, list):
+        return [row[name] for row in rows]
+    return list(rows[name])
+
+def _has_column(rows, name: str) -> bool:
+    """
+    Returns whether a dataset or a list of dicts has a column.
+    """
+    if isinstance(rows, list):
+        return bool(rows) and name in rows[0]
+    return name in rows.column_names
+
+def _padded_column(rows, name: str, width: int) -> tuple:
+    """
+    Returns a column of per-feature arrays of a dataset or of a list of dicts as one NumPy array padded with zeros to ``width`` tokens, and the length of every feature.
+
+    The column of a dataset is read from its Arrow buffers without creating a Python object per token.
+    """
+    if isinstance(rows, list):
+        values = [np.asarray(row[name]) for row in rows]
+        lengths = np.array([len(value) for value in values], dtype=np.int64)
+        padded = np.zeros((len(values), width) + (values[0].shape[1:] if values else ()), dtype=values[0].dtype if values else np.int32)
+        for i, value in enumerate(values):
+            padded[i, :len(value)] = value[:width]
+        return padded, lengths
+
+    import pyarrow.compute as pc
+    column = rows.data.table.column(name)
+    if rows._indices is not None: #a shuffled or filtered view
+        column = column.take(rows._indices.column(0))
+    column = column.combine_chunks()
+    lengths = pc.list_value_length(column).to_numpy(zero_copy_only=False).astype(np.int64)
+    values = pc.list_flatten(column)
+    token_shape = ()
+    while hasattr(values.type, 'value_type'): #e.g. the (start, end) pairs of the offsets
+        token_shape += (len(values) and len(pc.list_flatten(values)) // len(values),)
+        values = pc.list_flatten(values)
+    values = values.to_numpy(zero_copy_only=False).reshape((-1,) + token_shape)
+    padded = np.zeros((len(lengths), width) + token_shape, dtype=values.dtype)
+    row_starts = np.cumsum(lengths) - lengths
+    feature_rows = np.repeat(np.arange(len(lengths)), lengths)
+    token_positions = np.arange(len(values)) - np.repeat(row_starts, lengths)
+    keep = token_positions < width
+    padded[feature_rows[keep], token_positions[keep]] = values[keep]
+    return padded, lengths
+
+def length_grouped_batches(lengths, batch_size: int, shuffle: bool = True, seed: int = 42, bucket_size: int = 50) -> list:
+    """
+    Groups features of similar length into batches, so that padding each batch to its longest feature adds few padding tokens.
+
+    The features are shuffled and split into buckets of ``bucket_size`` batches. Within a bucket, the features are sorted by length and cut into batches, and the order of all batches is shuffled again, which keeps the batches random while their lengths stay similar.
+
+    :param lengths: The number of tokens of each feature, e.g. the "length" column of the preprocessed dataset.
+    :type lengths: list of int
+    :param batch_size: The number of features per batch.
+    :type batch_size: int
+    :param shuffle: Whether to shuffle the features and batches. Without shuffling, all features are sorted by length.
+    :type shuffle: bool
+    :param seed: The seed for shuffling.
+    :type seed: int
+    :param bucket_size: The number of batches per bucket of features sorted by length.
+    :type bucket_size: int
+    :return: The indices of the features of each batch, usable as ``batch_sampler`` of a ``torch.utils.data.DataLoader``.
+    :rtype: list of list of int
+    """
+    lengths = np.asarray(lengths)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    bucket = batch_size * bucket_size if shuffle else max(len(lengths), 1)
+    batches = []
+    for start in range(0, len(order), bucket):
+        indices = order[start:start + bucket]
+        indices = indices[np.argsort(-lengths[indices], kind="stable")]
+        batches.extend(indices[k:k + batch_size].tolist() for k in range(0, len(indices), batch_size))
+    if shuffle:
+        batches = [batches[k] for k in rng.permutation(len(batches))]
+    return batches
+
+def padding_efficiency(lengths, batch_size: int, max_length: int, seed: int = 42) -> "pd.DataFrame":
+    """
+    Compares the number of tokens the model processes when features are padded to ``max_length``, padded per random batch and padded per length-grouped batch.
+
+    The processing time of a transformer grows at least linearly with the padded sequence length, so the share of real tokens estimates the throughput gain of dynamic padding.
+
+    :param lengths: The number of tokens of each feature, e.g. the "length" column of the preprocessed dataset.
+    :type lengths: list of int
+    :param batch_size: The number of features per batch.
+    :type batch_size: int
+    :param max_length: The length the features are padded to with ``padding="max_length"``.
+    :type max_length: int
+    :param seed: The seed for the random batches.
+    :type seed: int
+    :return: A DataFrame with one row per strategy and the columns 'padded_tokens', 'real_tokens', 'efficiency' (the share of real tokens) and 'speedup' over ``max_length`` padding.
+    :rtype: pandas.DataFrame
+    """
+    lengths = np.asarray(lengths)
+    strategies = {
+        'max_length': [[k] for k in range(len(lengths))],
+        'dynamic': length_grouped_batches(lengths, batch_size, seed=seed, bucket_size=1),
+        'length_grouped': length_grouped_batches(lengths, batch_size, seed=seed),
+    }
+    rows = []
+    for strategy, batches in strategies.items():
+        if strategy == 'max_length':
+            padded = max_length * len(lengths)
+        else:
+            padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+        rows.append({'strategy': strategy, 'padded_tokens': padded, 'real_tokens': int(lengths.sum())})
+    report = pd.DataFrame(rows).set_index('strategy')
+    report['efficiency'] = report['real_tokens'] / report['padded_tokens']
+    report['speedup'] = report.loc['max_length', 'padded_tokens'] / report['padded_tokens']
+    return report
+
+def cached_features(dataset, preprocess_function, cache_dir: str = "feature_cache", padding="max_length", **map_kwargs):
+    """
+    Maps a preprocessing function over a dataset, or loads its features from the cache if the same dataset was already preprocessed the same way.
+
+    The cache is keyed by :py:func:`ft_an.feature_fingerprint`, so it is reused across runs and across notebooks whose models share a tokenizer, and is rebuilt as soon as the data, the tokenizer, ``max_length``, ``stride`` or ``padding`` change.
+    The features are stored as Arrow files with ``save_to_disk`` and memory-mapped by ``load_from_disk``, so loading them takes no time and no memory for copies.
+
+    :param dataset: The dataset to preprocess, e.g. ``raw_datasets["train"]``.
+    :type dataset: datasets.Dataset
+    :param preprocess_function: :py:func:`ft_an.preprocess_training_examples` or :py:func:`ft_an.preprocess_validation_examples`.
+    :type preprocess_function: callable
+    :param cache_dir: The directory of the cached features.
+    :type cache_dir: str
+    :param padding: The padding strategy passed to the preprocessing function.
+    :type padding: str or bool
+    :param map_kwargs: Further keyword arguments for ``dataset.map``, e.g. ``with_indices=True`` and ``fn_kwargs={"compact_offsets": True}``. Defaults to ``batched=True`` and removing the columns of ``dataset``.
+    :return: The tokenized features.
+    :rtype: datasets.Dataset
+    """
+    from datasets import load_from_disk
+
+    fn_kwargs = dict(map_kwargs.pop("fn_kwargs", None) or {}, padding=padding)
+    options = {name: value for name, value in fn_kwargs.items() if name != "padding"}
+    if map_kwargs.get("with_indices"):
+        options["with_indices"] = True
+    path = os.path.join(cache_dir, feature_fingerprint(dataset, preprocess_function, padding, options))
+    if os.path.isdir(path):
+        print(f"Loading cached features from {path}")
+        collector.count("features.cache_hits")
+        return load_from_disk(path)
+    collector.count("features.cache_misses")
+    map_kwargs.setdefault("batched", True)
+    map_kwargs.setdefault("remove_columns", dataset.column_names)
+    with collector.stage("features.preprocess", items=len(dataset)):
+        features = dataset.map(preprocess_function, fn_kwargs=fn_kwargs, **map_kwargs)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True) #left over from an interrupted run
+    features.save_to_disk(tmp_path)
+    os.replace(tmp_path, path) #a run interrupted while saving leaves no half-written cache behind
+    return load_from_disk(path)
+
+def feature_fingerprint(dataset, preprocess_function, padding="max_length", options: dict = None) -> str:
+    """
+    Returns a hash of everything the tokenized features of a dataset depend on: the content of the dataset, the preprocessing function, the global ``tokenizer`` (see :py:func:`ft_an.tokenizer_fingerprint`) with the version of the ``tokenizers`` library, ``max_length``, ``stride``, ``padding`` and further options of the preprocessing.
+
+    :param dataset: The dataset to preprocess.
+    :type dataset: datasets.Dataset
+    :param preprocess_function: The preprocessing function.
+    :type preprocess_function: callable
+    :param padding: The padding strategy passed to the preprocessing function.
+    :type padding: str or bool
+    :param options: Further arguments that change the features, e.g. ``{"compact_offsets": True}``.
+    :type options: dict or None
+    :return: The sha256 hex digest.
+    :rtype: str
+    """
+    import tokenizers
+
+    key = {
+        "dataset": dataset_content_hash(dataset),
+        "function": preprocess_function.__name__,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "tokenizers": tokenizers.__version__,
+        "max_length": max_length,
+        "stride": stride,
+        "padding": padding,
+    }
+    if options:
+        key["options"] = options
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+def dataset_content_hash(dataset) -> str:
+    """
+    Returns a hash of the schema and the rows of a dataset, read from its Arrow record batches.
+
+    Unlike the fingerprint of the ``datasets`` library, the hash does not depend on the cache files or the history of transforms of the dataset, so the same data gets the same hash in every run and notebook.
 
-def annotator(df, model_checkpoint: str):
+    :param dataset: A dataset.
+    :type dataset: datasets.Dataset
+    :return: The sha256 hex digest.
+    :rtype: str
+    """
+    table = dataset.data.table
+    if dataset._indices is not None: #a shuffled or filtered view, hash its rows in order
+        rows = dataset._indices.column(0)
+    else:
+        rows = np.arange(table.num_rows)
+    table = table.take(rows).combine_chunks() #fresh buffers, as slices serialize with their parent's offsets
+    digest = hashlib.sha256(table.schema.remove_metadata().to_string().encode("utf-8"))
+    for batch in table.to_batches(max_chunksize=65536):
+        digest.update(batch.serialize())
+    return digest.hexdigest()
+
+def annotator(df, model_checkpoint: str, batch_size: int = 1, device=None, num_threads: int = None, backend: str = "pytorch"):
   """
   Annotates a DataFrame with answers and confidence scores generated by a question-answering model.
 
+  The rows are fed to the pipeline in chunks with the given ``batch_size``, see :py:func:`ft_an.answer_questions`. A row the model fails on gets ``None`` without dropping the rest of its batch.
+  The pipeline is taken from the :py:data:`ft_an.model_registry`, so repeated calls with the same checkpoint skip loading the model.
+  With the "onnx" and "onnx-int8" backends, the model runs in ONNX Runtime on the CPU, see :py:func:`ft_an.load_onnx_model`. The answers and scores have the same format for every backend.
+
   :param df: The input DataFrame containing the following columns:
                - "context": The context text for each row.
                - "question": The question to be answered based on the context.
@@ -212,6 +881,14 @@ def annotator(df, model_checkpoint: str):
   :type df: pandas.DataFrame
   :param model_checkpoint: The model checkpoint or identifier to load the question-answering pipeline.
   :type model_checkpoint: str
+  :param batch_size: The number of question-context pairs passed through the model at once.
+  :type batch_size: int
+  :param device: The device to run the model on, e.g. ``-1`` or ``"cpu"`` for the CPU and ``0`` for the first GPU. Defaults to the pipeline default.
+  :type device: int or str or None
+  :param num_threads: The number of threads used for inference on the CPU, see :py:func:`ft_an.configure_threads`.
+  :type num_threads: int or None
+  :param backend: The inference backend, one of :py:data:`ft_an.INFERENCE_BACKENDS`: "pytorch", "onnx" or "onnx-int8" for an ONNX model with dynamic int8 quantization.
+  :type backend: str
   :return: A DataFrame with two new columns:
   
              - "answers_<model_checkpoint>": A list of dictionaries for each row containing:
@@ -224,30 +901,666 @@ def annotator(df, model_checkpoint: str):
   :rtype: pandas.DataFrame
   """
     
-  answers_list = []
-  scores_list = []
-  question_answerer = pipeline("question-answering", model=model_checkpoint)
-  for index, row in df.iterrows():
-      context = row['context']
-      question = row['question']
-      try:
-        result = question_answerer(question=question, context=context)
-        answers_list.append({'answer': result['answer'], 'answer_start': result['start'], 'model': model_checkpoint})
-        scores_list.append({'score':result['score'], 'model':model_checkpoint})
-      except Exception as e:
-        print(f"Error processing row {index}: {e}")
-        answers_list.append(None)
-        scores_list.append(None)
+  configure_threads(num_threads)
+  question_answerer = model_registry.get(model_checkpoint, device, backend)
+  with collector.stage("annotate.rows", items=len(df.index)):
+    results = answer_questions(question_answerer, df['question'].tolist(), df['context'].tolist(), batch_size, df.index)
+  answers_list = [{'answer': result['answer'], 'answer_start': result['start'], 'model': model_checkpoint} if result else None for result in results]
+  scores_list = [{'score': result['score'], 'model': model_checkpoint} if result else None for result in results]
   answers = "answers_" + model_checkpoint
   score = "score_" + model_checkpoint
   df[answers] = answers_list
   df[score] = scores_list
   return df
 
+def answer_questions(question_answerer, questions: list, contexts: list, batch_size: int = 1, index=None) -> list:
+  """
+  Runs a question-answering pipeline over lists of questions and contexts in batches.
+
+  The rows are passed to the pipeline in chunks of ``32 * batch_size``, and the pipeline groups each chunk into batches of ``batch_size``.
+  If a chunk fails, its rows are retried one by one, so only the rows the model cannot process get ``None``.
+
+  :param question_answerer: A question-answering pipeline.
+  :type question_answerer: transformers.QuestionAnsweringPipeline
+  :param questions: The questions to be answered.
+  :type questions: list of str
+  :param contexts: The context for each question.
+  :type contexts: list of str
+  :param batch_size: The number of question-context pairs passed through the model at once.
+  :type batch_size: int
+  :param index: The row labels used in error messages. Defaults to the positions.
+  :type index: list or None
+  :return: The pipeline output for each row, a dict with 'answer', 'score', 'start' and 'end', or None if the row failed.
+  :rtype: list of dict or None
+  """
+  index = list(range(len(questions))) if index is None else list(index)
+  results = [None] * len(questions)
+  rows = []
+  for k, (question, context) in enumerate(zip(questions, contexts)):
+    if isinstance(question, str) and question.strip() and isinstance(context, str) and context.strip():
+      rows.append(k)
+    else:
+      print(f"Error processing row {index[k]}: empty question or context")
+      collector.count("annotate.failed_rows")
+  chunk_size = 32 * batch_size
+  for start in range(0, len(rows), chunk_size):
+    chunk = rows[start:start + chunk_size]
+    try:
+      with collector.stage("annotate.inference", items=len(chunk)):
+        outputs = question_answerer(question=[questions[k] for k in chunk], context=[contexts[k] for k in chunk], batch_size=batch_size)
+      if isinstance(outputs, dict): #a single row is not wrapped in a list
+        outputs = [outputs]
+      for k, output in zip(chunk, outputs):
+        results[k] = output
+    except Exception:
+      for k in chunk: #isolate the failing rows without dropping the rest of the chunk
+        try:
+          results[k] = question_answerer(question=questions[k], context=contexts[k])
+        except Exception as e:
+          print(f"Error processing row {index[k]}: {e}")
+          collector.count("annotate.failed_rows")
+  return results
+
+def configure_threads(num_threads: int = None) -> int:
+  """
+  Sets the number of threads PyTorch uses for inference on the CPU.
+
+  :param num_threads: The number of threads. Defaults to the number of CPU cores available to the process.
+  :type num_threads: int or None
+  :return: The number of threads that was set.
+  :rtype: int
+  """
+  import torch
+  if num_threads is None:
+    num_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+  torch.set_num_threads(num_threads)
+  return num_threads
+
+class ModelRegistry:
+  """
+  Keeps loaded question-answering pipelines in memory and hands out the warm pipeline of a checkpoint.
+
+  When loading a model would exceed the memory budget, the least recently used pipelines are evicted first. The memory of a pipeline is the size of its model weights and buffers.
+  Models are loaded outside the lock of the registry, so a loaded pipeline is handed out right away while another checkpoint is still loading, and concurrent requests for the same checkpoint share a single load.
+
+  :param memory_budget: The maximum number of bytes of model weights kept in memory. The most recently requested pipeline is always kept, even if it alone exceeds the budget.
+  :type memory_budget: int or None
+  :param loader: A function that loads a pipeline from a checkpoint, a device and a backend. Defaults to ``pipeline("question-answering", model=model_checkpoint, device=device)`` for the "pytorch" backend and to :py:func:`ft_an.load_onnx_model` for the ONNX backends.
+  :type loader: callable or None
+  """
+
+  def __init__(self, memory_budget: int = 4 * 1024 ** 3, loader=None):
+    self.memory_budget = memory_budget
+    self.loader = loader or _load_pipeline
+    self.pipelines = collections.OrderedDict() #(checkpoint, device, backend) -> (pipeline, bytes), least recently used first
+    self.memory = 0
+    self.lock = threading.Lock()
+    self.loading = {} #(checkpoint, device, backend) -> Future of a load in progress
+    self.hits = 0
+    self.loads = 0
+    self.evictions = 0
+    self.load_seconds = 0.0
+
+  def get(self, model_checkpoint: str, device=None, backend: str = "pytorch"):
+    """
+    Returns the pipeline of a checkpoint, loading it if it is not in memory yet.
+
+    :param model_checkpoint: The model checkpoint or identifier.
+    :type model_checkpoint: str
+    :param device: The device to run the model on, see :py:func:`ft_an.annotator`.
+    :type device: int or str or None
+    :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+    :type backend: str
+    :return: The question-answering pipeline.
+    :rtype: transformers.QuestionAnsweringPipeline
+    """
+    key = (model_checkpoint, device, backend)
+    with self.lock:
+      if key in self.pipelines:
+        self.pipelines.move_to_end(key)
+        self.hits += 1
+        return self.pipelines[key][0]
+      future = self.loading.get(key)
+      loading = future is None
+      if loading:
+        future = self.loading[key] = Future()
+    if not loading: #another thread is loading the same checkpoint
+      return future.result()
+
+    try:
+      start = time.perf_counter()
+      with collector.stage("annotate.model_load"):
+        question_answerer = self.loader(model_checkpoint, device, backend)
+      seconds = time.perf_counter() - start
+      size = model_memory(question_answerer)
+    except BaseException as e:
+      with self.lock:
+        del self.loading[key]
+      future.set_exception(e)
+      raise
+    with self.lock:
+      self.load_seconds += seconds
+      self.loads += 1
+      while self.pipelines and self.memory_budget is not None and self.memory + size > self.memory_budget:
+        _, (_, evicted_size) = self.pipelines.popitem(last=False)
+        self.memory -= evicted_size
+        self.evictions += 1
+      self.pipelines[key] = (question_answerer, size)
+      self.memory += size
+      del self.loading[key]
+    future.set_result(question_answerer)
+    return question_answerer
+
+  def preload(self, model_checkpoints: list, device=None, backend: str = "pytorch"):
+    """
+    Loads the pipelines of several checkpoints ahead of time.
+
+    :param model_checkpoints: The model checkpoints or identifiers.
+    :type model_checkpoints: list of str
+    :param device: The device to run the models on.
+    :type device: int or str or None
+    :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+    :type backend: str
+    """
+    for model_checkpoint in model_checkpoints:
+      self.get(model_checkpoint, device, backend)
+
+  def clear(self):
+    """
+    Removes all pipelines from memory.
+    """
+    with self.lock:
+      self.pipelines.clear()
+      self.memory = 0
+
+  def metrics(self) -> dict:
+    """
+    Returns the usage of the registry.
+
+    :return: A dict with the number of 'hits', 'loads' and 'evictions', the total 'load_seconds', the 'memory' in bytes and the loaded 'checkpoints'.
+    :rtype: dict
+    """
+    with self.lock:
+      return {'hits': self.hits, 'loads': self.loads, 'evictions': self.evictions, 'load_seconds': self.load_seconds,
+              'memory': self.memory, 'checkpoints': [key[0] for key in self.pipelines]}
+
+def model_memory(question_answerer) -> int:
+  """
+  Returns the number of bytes taken by the weights and buffers of a pipeline's model, or by the model file of an ONNX model.
+
+  :param question_answerer: A pipeline or a PyTorch model.
+  :type question_answerer: transformers.Pipeline or torch.nn.Module
+  :return: The memory of the model in bytes, 0 if it has no parameters.
+  :rtype: int
+  """
+  model = getattr(question_answerer, 'model', question_answerer)
+  if not hasattr(model, 'parameters'):
+    model_path = getattr(model, 'model_path', None) #ONNX Runtime models
+    return os.path.getsize(model_path) if model_path and os.path.isfile(model_path) else 0
+  return sum(tensor.numel() * tensor.element_size() for tensor in itertools.chain(model.parameters(), model.buffers()))
+
+def _load_pipeline(model_checkpoint: str, device=None, backend: str = "pytorch"):
+  """
+  Loads the question-answering pipeline of a checkpoint with the given backend.
+  """
+  if backend not in INFERENCE_BACKENDS:
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {INFERENCE_BACKENDS}")
+  if backend == "pytorch":
+    return pipeline("question-answering", model=model_checkpoint, device=device)
+  from transformers import AutoTokenizer
+  model = load_onnx_model(model_checkpoint, quantize=backend == "onnx-int8")
+  return pipeline("question-answering", model=model, tokenizer=AutoTokenizer.from_pretrained(model_checkpoint))
+
+INFERENCE_BACKENDS = ("pytorch", "onnx", "onnx-int8")
+
+def load_onnx_model(model_checkpoint: str, quantize: bool = False, onnx_dir: str = "onnx_models", num_threads: int = None):
+  """
+  Loads a question-answering model into ONNX Runtime, exporting it to ONNX on first use.
+
+  The exported model is saved in ``onnx_dir``, so later runs load it directly. With ``quantize``, the weights are additionally quantized to int8 with dynamic quantization of the activations, which makes inference on the CPU faster at a small cost of accuracy, see :py:func:`ft_an.compare_backends`.
+  Requires the ``optimum[onnxruntime]`` package.
+
+  :param model_checkpoint: The model checkpoint or identifier.
+  :type model_checkpoint: str
+  :param quantize: Whether to quantize the model to int8.
+  :type quantize: bool
+  :param onnx_dir: The directory of the exported models.
+  :type onnx_dir: str
+  :param num_threads: The number of threads ONNX Runtime uses. Defaults to the number of threads of PyTorch, see :py:func:`ft_an.configure_threads`.
+  :type num_threads: int or None
+  :return: The ONNX Runtime model, which can be passed to ``pipeline("question-answering", model=...)``.
+  :rtype: optimum.onnxruntime.ORTModelForQuestionAnswering
+  """
+  import onnxruntime
+  import torch
+  from optimum.onnxruntime import ORTModelForQuestionAnswering, ORTQuantizer
+  from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+  session_options = onnxruntime.SessionOptions()
+  session_options.intra_op_num_threads = num_threads or torch.get_num_threads()
+  export_dir = os.path.join(onnx_dir, model_checkpoint.replace("/", "_"))
+  if not os.path.isfile(os.path.join(export_dir, "model.onnx")):
+    model = ORTModelForQuestionAnswering.from_pretrained(model_checkpoint, export=True)
+    model.save_pretrained(export_dir)
+  if not quantize:
+    return ORTModelForQuestionAnswering.from_pretrained(export_dir, session_options=session_options)
+
+  int8_dir = os.path.join(export_dir, "int8")
+  if not os.path.isfile(os.path.join(int8_dir, "model_quantized.onnx")):
+    if platform.machine().lower() in ("arm64", "aarch64"):
+      quantization_config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+      quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    quantizer = ORTQuantizer.from_pretrained(export_dir, file_name="model.onnx")
+    quantizer.quantize(save_dir=int8_dir, quantization_config=quantization_config)
+  return ORTModelForQuestionAnswering.from_pretrained(int8_dir, file_name="model_quantized.onnx", session_options=session_options)
+
+def compare_backends(df, model_checkpoint: str, backends: tuple = INFERENCE_BACKENDS, answer_col: str = "answers", batch_size: int = 16, num_threads: int = None):
+  """
+  Compares the accuracy and latency of the inference backends of :py:func:`ft_an.annotator` on an annotated DataFrame.
+
+  Every backend answers all rows of ``df``, and its predictions are scored against the annotated answers with the global ``metric``, e.g. ``evaluate.load("squad")``. Loading and exporting the models is not part of the measured time.
+
+  :param df: The DataFrame containing the columns "question", "context" and the annotated answers, dicts with "text" and "answer_start" lists as in the expanded dataset.
+  :type df: pandas.DataFrame
+  :param model_checkpoint: The model checkpoint or identifier.
+  :type model_checkpoint: str
+  :param backends: The backends to compare. The first one is the baseline for 'speedup' and 'agreement'.
+  :type backends: tuple of str
+  :param answer_col: The column of the annotated answers.
+  :type answer_col: str
+  :param batch_size: The number of question-context pairs passed through the model at once.
+  :type batch_size: int
+  :param num_threads: The number of threads used for inference on the CPU, see :py:func:`ft_an.configure_threads`.
+  :type num_threads: int or None
+  :return: A DataFrame with one row per backend and the columns 'exact_match', 'f1', 'seconds', 'rows_per_second', 'speedup' and 'agreement', the share of rows with the same answer as the first backend.
+  :rtype: pandas.DataFrame
+  """
+  configure_threads(num_threads)
+  questions = df['question'].tolist()
+  contexts = df['context'].tolist()
+  references = [{"id": str(k), "answers": ast.literal_eval(answer) if isinstance(answer, str) else answer} for k, answer in enumerate(df[answer_col])]
+  rows = []
+  baseline = None
+  for backend in backends:
+    question_answerer = model_registry.get(model_checkpoint, backend=backend)
+    start = time.perf_counter()
+    results = answer_questions(question_answerer, questions, contexts, batch_size, df.index)
+    seconds = time.perf_counter() - start
+    texts = [result['answer'] if result else "" for result in results]
+    baseline = texts if baseline is None else baseline
+    scores = metric.compute(predictions=[{"id": str(k), "prediction_text": text} for k, text in enumerate(texts)], references=references)
+    rows.append({'backend': backend, 'exact_match': scores['exact_match'], 'f1': scores['f1'], 'seconds': seconds,
+                 'rows_per_second': len(texts) / seconds, 'agreement': np.mean([text == first for text, first in zip(texts, baseline)])})
+  report = pd.DataFrame(rows).set_index('backend')
+  report['speedup'] = report['seconds'].iloc[0] / report['seconds']
+  return report[['exact_match', 'f1', 'seconds', 'rows_per_second', 'speedup', 'agreement']]
+
+model_registry = ModelRegistry()
+collector.register("model_registry", model_registry.metrics)
+worker_threads = None #inference threads of a worker process started by preload_pool
+
+def preload_pool(model_checkpoints: list, n_workers: int = 2, device=None, memory_budget: int = 4 * 1024 ** 3, backend: str = "pytorch"):
+  """
+  Starts a pool of worker processes that each load the given checkpoints into their :py:data:`ft_an.model_registry` once.
+
+  The available cores are split evenly among the workers. Jobs submitted to the pool, e.g. by :py:func:`ft_an.annotate_shards`, find the models already loaded.
+
+  :param model_checkpoints: The model checkpoints or identifiers to load in every worker.
+  :type model_checkpoints: list of str
+  :param n_workers: The number of worker processes.
+  :type n_workers: int
+  :param device: The device to run the models on.
+  :type device: int or str or None
+  :param memory_budget: The memory budget of the registry of every worker in bytes.
+  :type memory_budget: int or None
+  :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+  :type backend: str
+  :return: The warm process pool. Shut it down with ``shutdown()`` when it is no longer needed.
+  :rtype: concurrent.futures.ProcessPoolExecutor
+  """
+  cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+  num_threads = max(1, cores // n_workers)
+  executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(list(model_checkpoints), device, memory_budget, num_threads, backend))
+  list(executor.map(_worker_threads, range(n_workers))) #start all workers now instead of on the first job
+  return executor
+
+def _init_worker(model_checkpoints: list, device, memory_budget: int, num_threads: int, backend: str):
+  """
+  Loads the checkpoints into the registry of a new worker process.
+  """
+  global model_registry, worker_threads
+  worker_threads = configure_threads(num_threads)
+  model_registry = ModelRegistry(memory_budget)
+  model_registry.preload(model_checkpoints, device, backend)
+
+def _worker_threads(_=None):
+  """
+  Returns the number of inference threads of a worker process.
+  """
+  return worker_threads
+
+def annotate_shards(shards: list, model_checkpoint: str, executor=None, batch_size: int = 1, device=None, backend: str = "pytorch") -> list:
+  """
+  Annotates several DataFrames with one model, see :py:func:`ft_an.annotator`.
+
+  With an ``executor`` from :py:func:`ft_an.preload_pool`, the shards are annotated in parallel by the warm workers. Otherwise they are annotated one after another in this process, and the model is loaded only once through the :py:data:`ft_an.model_registry`.
+
+  :param shards: The DataFrames to annotate, each containing the columns "question" and "context".
+  :type shards: list of pandas.DataFrame
+  :param model_checkpoint: The model checkpoint or identifier.
+  :type model_checkpoint: str
+  :param executor: A warm process pool from :py:func:`ft_an.preload_pool`.
+  :type executor: concurrent.futures.ProcessPoolExecutor or None
+  :param batch_size: The number of question-context pairs passed through the model at once.
+  :type batch_size: int
+  :param device: The device to run the model on.
+  :type device: int or str or None
+  :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+  :type backend: str
+  :return: The annotated shards in the order they were given.
+  :rtype: list of pandas.DataFrame
+  """
+  if executor is None:
+    return [annotator(shard, model_checkpoint, batch_size, device, backend=backend) for shard in shards]
+  return list(executor.map(_annotate_shard, shards, itertools.repeat(model_checkpoint), itertools.repeat(batch_size), itertools.repeat(device), itertools.repeat(backend)))
+
+def _annotate_shard(shard, model_checkpoint: str, batch_size: int, device, backend: str):
+  """
+  Annotates one shard in a worker process with the worker's thread count.
+  """
+  return annotator(shard, model_checkpoint, batch_size, device, num_threads=worker_threads, backend=backend)
+
+def annotate_stream(input_path: str, output_dir: str, model_checkpoint: str, chunk_size: int = 10000, batch_size: int = 16, device=None,
+                    backend: str = "pytorch", columns: list = None) -> list:
+  """
+  Annotates a CSV or Parquet file that does not fit into memory chunk by chunk and writes every annotated chunk to its own Parquet shard.
+
+  Only one chunk is held in memory at a time. A shard is written to a hidden temporary file and renamed when it is complete, so after a crash the job can be restarted with the same arguments and continues after the last complete shard.
+  Every shard has the same schema, even if the model failed on all rows of its chunk, so the shards can be read back together with ``pd.read_parquet(output_dir)``.
+
+  :param input_path: The path of a CSV or Parquet file containing the columns "question" and "context".
+  :type input_path: str
+  :param output_dir: The directory of the shards "part-00000.parquet", "part-00001.parquet", ...
+  :type output_dir: str
+  :param model_checkpoint: The model checkpoint or identifier, see :py:func:`ft_an.annotator`.
+  :type model_checkpoint: str
+  :param chunk_size: The number of rows per chunk and shard.
+  :type chunk_size: int
+  :param batch_size: The number of question-context pairs passed through the model at once.
+  :type batch_size: int
+  :param device: The device to run the model on.
+  :type device: int or str or None
+  :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+  :type backend: str
+  :param columns: The columns to read from the input file. Defaults to all columns.
+  :type columns: list of str or None
+  :return: The paths of all shards.
+  :rtype: list of str
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  manifest = {'input_path': os.path.abspath(input_path), 'model_checkpoint': model_checkpoint, 'backend': backend, 'chunk_size': chunk_size, 'columns': columns}
+  manifest_path = os.path.join(output_dir, '_manifest.json')
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      previous = json.load(f)
+    if previous != manifest: #other chunks would not line up with the existing shards
+      raise ValueError(f"{output_dir} holds shards of a different job: {previous}")
+  else:
+    with open(manifest_path, 'w') as f:
+      json.dump(manifest, f)
+
+  paths = []
+  offset = 0
+  for k, chunk in enumerate(_read_chunks(input_path, chunk_size, columns)):
+    path = os.path.join(output_dir, f"part-{k:05d}.parquet")
+    paths.append(path)
+    chunk.index = pd.RangeIndex(offset, offset + len(chunk.index)) #row labels of the whole file
+    offset += len(chunk.index)
+    if os.path.exists(path):
+      collector.count("annotate.skipped_shards")
+      continue
+    chunk = annotator(chunk, model_checkpoint, batch_size, device, backend=backend)
+    tmp_path = os.path.join(output_dir, f".part-{k:05d}.parquet.tmp") #hidden files are skipped by Parquet readers
+    with collector.stage("annotate.write_shard", items=len(chunk.index)):
+      chunk.to_parquet(tmp_path, schema=_shard_schema(chunk, model_checkpoint))
+      os.replace(tmp_path, path)
+    print(f"Wrote {path} with {len(chunk.index)} rows")
+  return paths
+
+def _shard_schema(chunk, model_checkpoint: str):
+  """
+  Returns the Parquet schema of an annotated chunk with fixed struct types for its answer and score columns, which would be stored as nulls in a chunk where every row failed.
+  """
+  import pyarrow as pa
+  schema = pa.Schema.from_pandas(chunk)
+  for name, fields in (("answers_" + model_checkpoint, [('answer', pa.string()), ('answer_start', pa.int64()), ('model', pa.string())]),
+                       ("score_" + model_checkpoint, [('score', pa.float64()), ('model', pa.string())])):
+    schema = schema.set(schema.get_field_index(name), pa.field(name, pa.struct(fields)))
+  return schema
+
+def _read_chunks(input_path: str, chunk_size: int, columns: list = None):
+  """
+  Yields the rows of a CSV or Parquet file as DataFrames of at most ``chunk_size`` rows.
+  """
+  if input_path.endswith('.parquet'):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(input_path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+      yield batch.to_pandas()
+  else:
+    yield from pd.read_csv(input_path, chunksize=chunk_size, usecols=columns)
+
+def ensemble_annotator(df, model_checkpoints: list, batch_size: int = 16, max_length: int = 384, stride: int = 128, max_answer_length: int = 15, num_threads: int = None,
+                       device=None, backend: str = "pytorch"):
+  """
+  Annotates a DataFrame with the answers of several question-answering models in one pass and ranks them.
+
+  Checkpoints whose tokenizers split text alike (see :py:func:`ft_an.tokenizer_fingerprint`) and take the same model inputs share a single tokenization of the questions and contexts, so a BERT model still gets its token type ids next to a DistilBERT model. The models then run concurrently, each on its share of the CPU cores.
+  The models and tokenizers are taken from the :py:data:`ft_an.model_registry`, so they are shared with :py:func:`ft_an.annotator` and loaded only once per session.
+  A span is scored by the product of its start and end probabilities over the context tokens and picked among the best start and end candidates with :py:func:`ft_an.best_spans`. Long contexts are split into overlapping windows of which the best span wins.
+
+  :param df: The input DataFrame containing the columns "question" and "context".
+  :type df: pandas.DataFrame
+  :param model_checkpoints: The model checkpoints or identifiers of the question-answering models.
+  :type model_checkpoints: list of str
+  :param batch_size: The number of tokenized windows passed through a model at once.
+  :type batch_size: int
+  :param max_length: The maximum number of tokens per window.
+  :type max_length: int
+  :param stride: The number of overlapping tokens between two windows of the same context.
+  :type stride: int
+  :param max_answer_length: The maximum number of tokens of an answer.
+  :type max_answer_length: int
+  :param num_threads: The total number of threads used for inference on the CPU, split evenly among the models. Defaults to the number of available cores. The previous thread count of PyTorch is restored afterwards.
+  :type num_threads: int or None
+  :param device: The device to run the models on, see :py:func:`ft_an.annotator`.
+  :type device: int or str or None
+  :param backend: The inference backend, see :py:func:`ft_an.annotator`.
+  :type backend: str
+  :return: The DataFrame with the "answers_<model_checkpoint>" and "score_<model_checkpoint>" columns of :py:func:`ft_an.annotator` for every model, ranked by :py:func:`ft_an.rank_answers`.
+  :rtype: pandas.DataFrame
+  """
+  import torch
+
+  questions = df['question'].tolist()
+  contexts = df['context'].tolist()
+  rows = []
+  for k, (question, context) in enumerate(zip(questions, contexts)):
+    if isinstance(question, str) and question.strip() and isinstance(context, str) and context.strip():
+      rows.append(k)
+    else:
+      print(f"Error processing row {df.index[k]}: empty question or context")
+
+  question_answerers = {model_checkpoint: model_registry.get(model_checkpoint, device, backend) for model_checkpoint in model_checkpoints}
+  encodings = {} #one tokenization per tokenizer fingerprint and set of model inputs
+  tokenizers = {}
+  for model_checkpoint, question_answerer in question_answerers.items():
+    tokenizer = question_answerer.tokenizer
+    key = (tokenizer_fingerprint(tokenizer), tuple(tokenizer.model_input_names))
+    if key not in encodings:
+      with collector.stage("ensemble.tokenize", items=len(rows)):
+        encodings[key] = _tokenize_qa(tokenizer, [questions[k].strip() for k in rows], [contexts[k] for k in rows], max_length, stride)
+    tokenizers[model_checkpoint] = (tokenizer, encodings[key])
+
+  previous_threads = torch.get_num_threads()
+  try:
+    configure_threads(max(1, configure_threads(num_threads) // max(1, len(model_checkpoints))))
+    with ThreadPoolExecutor(max_workers=max(1, len(model_checkpoints))) as executor:
+      futures = {model_checkpoint: executor.submit(_run_qa_model, question_answerers[model_checkpoint].model, tokenizer, encoding, batch_size, max_answer_length)
+                 for model_checkpoint, (tokenizer, encoding) in tokenizers.items()}
+      for model_checkpoint, future in futures.items():
+        features, starts, ends, scores = future.result()
+        answers_list = [None] * len(df.index)
+        scores_list = [None] * len(df.index)
+        encoding = tokenizers[model_checkpoint][1]
+        for feature, start, end, score in zip(features, starts, ends, scores):
+          if not np.isfinite(score): #no valid span in any window of the row
+            continue
+          k = rows[encoding['overflow_to_sample_mapping'][feature]]
+          char_start = encoding['offset_mapping'][feature][start][0]
+          char_end = encoding['offset_mapping'][feature][end][1]
+          answers_list[k] = {'answer': contexts[k][char_start:char_end], 'answer_start': char_start, 'model': model_checkpoint}
+          scores_list[k] = {'score': float(np.exp(score)), 'model': model_checkpoint}
+        df["answers_" + model_checkpoint] = answers_list
+        df["score_" + model_checkpoint] = scores_list
+  finally:
+    torch.set_num_threads(previous_threads) #later calls in the session keep their thread count
+  return rank_answers(df)
+
+def tokenizer_fingerprint(tokenizer) -> str:
+  """
+  Returns a hash that is equal for tokenizers that split text into the same tokens, e.g. for checkpoints fine-tuned from the same base model.
+
+  :param tokenizer: A Huggingface tokenizer.
+  :type tokenizer: transformers.PreTrainedTokenizerBase
+  :return: The sha256 hex digest of the tokenizer configuration.
+  :rtype: str
+  """
+  if getattr(tokenizer, 'is_fast', False):
+    config = json.loads(tokenizer.backend_tokenizer.to_str())
+    config.pop('truncation', None) #set by the last call, not part of the tokenizer
+    config.pop('padding', None)
+  else:
+    config = {'type': type(tokenizer).__name__, 'vocab': sorted(tokenizer.get_vocab().items())}
+  return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+def best_spans(start_logits, end_logits, context_mask, max_answer_length: int, n_best: int = 20, candidates=None):
+  """
+  Finds the best answer span of every feature from its start and end logits.
+
+  The ``n_best`` start and end candidates of all features are taken at once, and every pair is scored by the sum of its start and end logit. Pairs outside the context, ending before they start or longer than ``max_answer_length`` tokens are skipped.
+
+  :param start_logits: The start logits, one row per feature.
+  :type start_logits: np.ndarray
+  :param end_logits: The end logits, one row per feature.
+  :type end_logits: np.ndarray
+  :param context_mask: True for the tokens that belong to the context.
+  :type context_mask: np.ndarray
+  :param max_answer_length: The maximum number of tokens of an answer.
+  :type max_answer_length: int
+  :param n_best: The number of start and end candidates per feature.
+  :type n_best: int
+  :param candidates: The start and end candidates of every feature, if they were already taken with :py:func:`ft_an.top_candidates`.
+  :type candidates: tuple of np.ndarray or None
+  :return: A tuple containing:
+
+             - The start token index of the best span of each feature.
+             - The end token index of the best span of each feature.
+             - The score of the best span of each feature, -inf if the feature has no valid span.
+  :rtype: tuple of np.ndarray
+  """
+  start_logits = np.asarray(start_logits)
+  end_logits = np.asarray(end_logits)
+  context_mask = np.asarray(context_mask, dtype=bool)
+  top_starts, top_ends = candidates if candidates is not None else (top_candidates(start_logits, n_best), top_candidates(end_logits, n_best))
+  k = top_starts.shape[1]
+
+  pair_scores = np.take_along_axis(start_logits, top_starts, axis=1)[:, :, None] + np.take_along_axis(end_logits, top_ends, axis=1)[:, None, :]
+  lengths = top_ends[:, None, :] - top_starts[:, :, None] + 1
+  valid = (np.take_along_axis(context_mask, top_starts, axis=1)[:, :, None] & np.take_along_axis(context_mask, top_ends, axis=1)[:, None, :]
+           & (lengths >= 1) & (lengths <= max_answer_length))
+  pair_scores = np.where(valid, pair_scores, -np.inf).reshape(len(pair_scores), -1)
+
+  rows = np.arange(len(pair_scores))
+  best = pair_scores.argmax(axis=1)
+  return top_starts[rows, best // k], top_ends[rows, best % k], pair_scores[rows, best]
+
+def top_candidates(logits, n_best: int = 20):
+  """
+  Returns the indices of the ``n_best`` highest logits of every row, in no particular order.
+
+  :param logits: The logits, one row per feature.
+  :type logits: np.ndarray
+  :param n_best: The number of candidates per row.
+  :type n_best: int
+  :return: The candidate indices with one row per feature.
+  :rtype: np.ndarray
+  """
+  k = min(n_best, logits.shape[1])
+  return np.argpartition(-logits, k - 1, axis=1)[:, :k]
+
+def _tokenize_qa(tokenizer, questions: list, contexts: list, max_length: int, stride: int) -> dict:
+  """
+  Tokenizes question-context pairs into overlapping windows without padding and marks the context tokens of each window.
+  """
+  inputs = tokenizer(
+      questions,
+      contexts,
+      max_length=max_length,
+      truncation="only_second",
+      stride=stride,
+      return_overflowing_tokens=True,
+      return_offsets_mapping=True,
+  )
+  encoding = dict(inputs)
+  encoding['context_mask'] = [np.array([sequence_id == 1 for sequence_id in inputs.sequence_ids(i)]) for i in range(len(inputs['input_ids']))]
+  return encoding
+
+def _run_qa_model(model, tokenizer, encoding: dict, batch_size: int, max_answer_length: int):
+  """
+  Runs a question-answering model over tokenized windows and returns the best window of every row with its span and log-probability.
+  """
+  import torch
+
+  input_names = [name for name in tokenizer.model_input_names if name in encoding]
+  n_features = len(encoding['input_ids'])
+  starts = np.zeros(n_features, dtype=int)
+  ends = np.zeros(n_features, dtype=int)
+  scores = np.full(n_features, -np.inf)
+  with torch.inference_mode():
+    for start in range(0, n_features, batch_size):
+      stop = min(start + batch_size, n_features)
+      batch = tokenizer.pad({name: encoding[name][start:stop] for name in input_names}, return_tensors='pt').to(model.device)
+      with collector.stage("ensemble.inference", items=stop - start):
+        outputs = model(**batch)
+      width = outputs.start_logits.shape[1]
+      context_mask = np.zeros((stop - start, width), dtype=bool)
+      for i, mask in enumerate(encoding['context_mask'][start:stop]):
+        context_mask[i, :len(mask)] = mask
+      start_probs = _log_softmax(np.where(context_mask, outputs.start_logits.float().cpu().numpy(), -np.inf))
+      end_probs = _log_softmax(np.where(context_mask, outputs.end_logits.float().cpu().numpy(), -np.inf))
+      starts[start:stop], ends[start:stop], scores[start:stop] = best_spans(start_probs, end_probs, context_mask, max_answer_length)
+
+  sample_map = np.asarray(encoding['overflow_to_sample_mapping'])
+  order = np.lexsort((-scores, sample_map)) #best window first within each row
+  features = order[np.unique(sample_map[order], return_index=True)[1]]
+  return features, starts[features], ends[features], scores[features]
+
+def _log_softmax(logits):
+  """
+  Returns the log-probabilities of logits along the last axis, where -inf logits get a probability of 0.
+  """
+  shifted = logits - logits.max(axis=-1, keepdims=True)
+  return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
 def rank_answers(df):
     """
     Ranks answers based on their scores for each row in a DataFrame and adds the ranked answers and scores as new columns.
 
+    All score columns are unpacked into one matrix, and the best model per row is picked with a single ``argmax``, so any number of model columns can be ranked at once.
+    Score and answer columns are paired by the model name after the prefix. Rows where every model failed get no answer and a NaN score.
+
     :param df: A pandas DataFrame containing columns for scores and answers. The score columns should have names containing the substring 'score_', and the answer columns should have names containing the substring 'answers_'.
     :type df: pandas.DataFrame
     :return: A modified DataFrame with two new columns:
@@ -259,22 +1572,37 @@ def rank_answers(df):
     # Identify columns containing scores and answers
     score_cols = [col for col in df.columns if 'score_' in col]
     answer_cols = [col for col in df.columns if 'answers_' in col]
+    answer_by_model = {col.split('answers_', 1)[1]: col for col in answer_cols}
+    answer_cols = [answer_by_model.get(score_col.split('score_', 1)[1], answer_col) for score_col, answer_col in zip(score_cols, answer_cols)]
+    score_cols = score_cols[:len(answer_cols)]
+    if not score_cols:
+        df['ranked_answer'] = None
+        df['ranked_score'] = np.nan
+        return df
+
+    scores = np.empty((len(df.index), len(score_cols)))
+    for k, score_col in enumerate(score_cols):
+        scores[:, k] = [_score_value(score) for score in df[score_col]]
+    scores[np.isnan(scores)] = -np.inf #failed rows never win
+    rows = np.arange(len(df.index))
+    best = scores.argmax(axis=1)
+    best_scores = scores[rows, best]
+    found = np.isfinite(best_scores)
+    answers = df[answer_cols].to_numpy(dtype=object)
 
-    ranked_answers = []
-    ranked_scores = []
-    for index, row in df.iterrows():
-        best_score = -1  # Initialize with a value lower than any possible score
-        best_answer = None
-        for score_col, answer_col in zip(score_cols, answer_cols):
-            score = row[score_col]
-            if score:
-              score_value = score['score']
-              if score_value > best_score:
-                  best_score = score_value
-                  best_answer = row[answer_col]
-        ranked_answers.append(best_answer)
-        ranked_scores.append(score_value if score_value > best_score else best_score)
-
-    df['ranked_answer'] = ranked_answers
-    df['ranked_score'] = ranked_scores
+    df['ranked_answer'] = np.where(found, answers[rows, best], None)
+    df['ranked_score'] = np.where(found, best_scores, np.nan)
     return df
+
+def _score_value(score) -> float:
+    """
+    Returns the confidence of a score cell, which holds a dict with a 'score' key, or NaN if the model failed on the row.
+    """
+    if isinstance(score, str):
+        score = ast.literal_eval(score) if score.strip() else None #stringified dict, e.g. after a round trip through CSV
+    if isinstance(score, dict):
+        return float(score['score'])
+    if isinstance(score, (int, float)) and not isinstance(score, bool):
+        return float(score)
+    return np.nan
+
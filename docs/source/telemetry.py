@@ -0,0 +1,344 @@
+"""
+telemetry - The module to time the stages of the data generation and annotation pipeline
+"""
+
+__version__ = "0.1.0"
+
+import bisect
+import json
+import math
+import os
+import re
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+"""Upper bounds in seconds of the latency histogram buckets, from a millisecond for a cached prompt to two minutes for a throttled request."""
+
+class Histogram:
+    """
+    A latency histogram with fixed bucket bounds, as used by Prometheus.
+
+    Recording a value only increments one bucket, so the memory of the histogram does not grow with the number of values.
+
+    :param buckets: The sorted upper bounds of the buckets. Values above the last bound are counted in an overflow bucket.
+    :type buckets: tuple of float
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) #the last bucket counts the values above all bounds
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """
+        Records a value.
+
+        :param value: The value, e.g. a latency in seconds.
+        :type value: float
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by linear interpolation within its bucket.
+
+        :param q: The quantile between 0 and 1, e.g. 0.95.
+        :type q: float
+        :return: The estimated quantile, 0.0 if no value was recorded.
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for k, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[k - 1] if k else 0.0
+                upper = min(self.buckets[k], self.max) if k < len(self.buckets) else self.max
+                return lower + (upper - lower) * max(rank - seen, 0) / count
+            seen += count
+        return self.max
+
+class _StageTimer:
+    """
+    Times a block of code and records the elapsed time as one call of a stage.
+    """
+
+    __slots__ = ('telemetry', 'name', 'items', 'start')
+
+    def __init__(self, telemetry, name: str, items: int):
+        self.telemetry = telemetry
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.telemetry.observe(self.name, time.perf_counter() - self.start, self.items, error=exc_type is not None)
+        return False
+
+class _NoTimer:
+    """
+    The timer of a disabled collector, which records nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+class Telemetry:
+    """
+    A thread-safe collector of stage timings, counters and the metrics of other components.
+
+    - Stages are timed with :py:meth:`stage` and keep a latency histogram of their calls, the number of processed items (e.g. rows) and the number of failed calls.
+    - Counters are incremented with :py:meth:`count` and report their rate since the collector was started.
+    - Sources are functions returning a dict of metrics, e.g. :py:meth:`data_gen.RateLimiter.metrics`. They are only called when a snapshot is taken, so they cost nothing while the pipeline runs.
+
+    Recording a call takes a lock and a bucket lookup, a few microseconds, so the collector can stay enabled in production.
+    Every process has its own collector, so the metrics of worker processes are not included in the collector of the main process.
+
+    :param enabled: Whether stages and counters are recorded. A disabled collector still reports its sources.
+    :type enabled: bool
+    :param buckets: The upper bounds of the latency histogram buckets in seconds.
+    :type buckets: tuple of float
+    """
+
+    def __init__(self, enabled: bool = True, buckets: tuple = LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.sources = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all recorded stages and counters and restarts the clock of the rates. Sources are kept.
+        """
+        with self._lock:
+            self.stages = {} #name -> [histogram, items, errors]
+            self.counters = {}
+            self._start = time.perf_counter()
+
+    def stage(self, name: str, items: int = 0):
+        """
+        Returns a context manager that times one call of a stage.
+
+        >>> with collector.stage("annotate.inference", items=len(chunk)):
+        ...     outputs = question_answerer(question=questions, context=contexts)
+
+        :param name: The name of the stage, e.g. "generate.request".
+        :type name: str
+        :param items: The number of items processed by the call, used for the items per second of the stage.
+        :type items: int
+        :return: A context manager recording the elapsed time on exit. A call that raises an exception is counted as an error.
+        :rtype: object
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return _StageTimer(self, name, items)
+
+    def observe(self, name: str, seconds: float, items: int = 0, error: bool = False):
+        """
+        Records one call of a stage that was timed elsewhere, e.g. the wait returned by :py:meth:`data_gen.RateLimiter.acquire`.
+
+        :param name: The name of the stage.
+        :type name: str
+        :param seconds: The duration of the call.
+        :type seconds: float
+        :param items: The number of items processed by the call.
+        :type items: int
+        :param error: Whether the call failed.
+        :type error: bool
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [Histogram(self.buckets), 0, 0]
+            stage[0].observe(seconds)
+            stage[1] += items
+            stage[2] += error
+
+    def count(self, name: str, value: int = 1):
+        """
+        Increments a counter.
+
+        :param name: The name of the counter, e.g. "generate.cache_hits".
+        :type name: str
+        :param value: The increment.
+        :type value: int
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register(self, name: str, source):
+        """
+        Adds a source of metrics to the snapshots. A source registered again under the same name replaces the previous one.
+
+        :param name: The name of the source, e.g. "prompt_cache".
+        :type name: str
+        :param source: A function without arguments returning a dict of metrics.
+        :type source: callable
+        """
+        with self._lock:
+            self.sources[name] = source
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current metrics.
+
+        :return: A dict with:
+
+                 - 'timestamp' and 'uptime_seconds': When the snapshot was taken and the seconds since the collector was started or reset.
+                 - 'stages': For every stage, the number of 'calls' and 'errors', the total 'seconds', the 'mean_seconds', the estimated 'p50_seconds', 'p95_seconds' and 'p99_seconds', the 'max_seconds', the processed 'items' and the 'items_per_second' within the stage.
+                 - 'counters': For every counter, its 'value' and its 'per_second' rate over the uptime.
+                 - 'sources': The dict returned by every source, or a dict with the 'error' if the source failed.
+        :rtype: dict
+        """
+        with self._lock:
+            uptime = time.perf_counter() - self._start
+            stages = {}
+            for name, (histogram, items, errors) in sorted(self.stages.items()):
+                stages[name] = {'calls': histogram.count, 'errors': errors, 'seconds': histogram.sum,
+                                'mean_seconds': histogram.sum / histogram.count,
+                                'p50_seconds': histogram.quantile(0.5), 'p95_seconds': histogram.quantile(0.95),
+                                'p99_seconds': histogram.quantile(0.99), 'max_seconds': histogram.max,
+                                'items': items, 'items_per_second': items / histogram.sum if histogram.sum else 0.0}
+            counters = {name: {'value': value, 'per_second': value / uptime if uptime else 0.0} for name, value in sorted(self.counters.items())}
+            sources = dict(self.sources)
+        source_metrics = {}
+        for name, source in sorted(sources.items()): #outside the lock, a source may take its own lock
+            try:
+                source_metrics[name] = source()
+            except Exception as e:
+                source_metrics[name] = {'error': str(e)}
+        return {'timestamp': time.time(), 'uptime_seconds': uptime, 'stages': stages, 'counters': counters, 'sources': source_metrics}
+
+    def to_json(self, indent: int = None) -> str:
+        """
+        Returns a snapshot as a JSON document, e.g. for a structured log line.
+
+        :param indent: The indentation of the JSON document. Defaults to a single line.
+        :type indent: int or None
+        :return: The snapshot from :py:meth:`snapshot` as JSON.
+        :rtype: str
+        """
+        return json.dumps(self.snapshot(), indent=indent, default=str)
+
+    def to_prometheus(self, prefix: str = "pds") -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+
+        Stages become the histogram ``<prefix>_stage_seconds`` and the counters ``<prefix>_stage_items_total`` and ``<prefix>_stage_errors_total`` with a "stage" label,
+        counters become ``<prefix>_events_total`` with a "name" label, and the numeric metrics of the sources become the gauge ``<prefix>_source_value`` with a "source" and a "metric" label.
+
+        :param prefix: The prefix of the metric names.
+        :type prefix: str
+        :return: The metrics, one sample per line.
+        :rtype: str
+        """
+        with self._lock:
+            stages = [(name, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count, items, errors)
+                      for name, (histogram, items, errors) in sorted(self.stages.items())]
+            counters = sorted(self.counters.items())
+        snapshot_sources = self.snapshot()['sources']
+        lines = [f"# HELP {prefix}_stage_seconds Duration of the calls of a pipeline stage.", f"# TYPE {prefix}_stage_seconds histogram"]
+        for name, buckets, counts, total, calls, _, _ in stages:
+            cumulative = 0
+            for bound, count in zip(buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{_escape(name)}",le="{_format_bound(bound)}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{_escape(name)}"}} {total!r}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{_escape(name)}"}} {calls}')
+        lines += [f"# HELP {prefix}_stage_items_total Items processed by a pipeline stage.", f"# TYPE {prefix}_stage_items_total counter"]
+        lines += [f'{prefix}_stage_items_total{{stage="{_escape(name)}"}} {items}' for name, *_, items, _ in stages]
+        lines += [f"# HELP {prefix}_stage_errors_total Failed calls of a pipeline stage.", f"# TYPE {prefix}_stage_errors_total counter"]
+        lines += [f'{prefix}_stage_errors_total{{stage="{_escape(name)}"}} {errors}' for name, *_, errors in stages]
+        lines += [f"# HELP {prefix}_events_total Events counted by the pipeline.", f"# TYPE {prefix}_events_total counter"]
+        lines += [f'{prefix}_events_total{{name="{_escape(name)}"}} {value}' for name, value in counters]
+        lines += [f"# HELP {prefix}_source_value Metrics reported by the components of the pipeline.", f"# TYPE {prefix}_source_value gauge"]
+        for source, metrics in snapshot_sources.items():
+            for metric, value in sorted(metrics.items()):
+                if isinstance(value, (int, float)): #e.g. not the list of loaded checkpoints
+                    lines.append(f'{prefix}_source_value{{source="{_escape(source)}",metric="{_escape(metric)}"}} {float(value)!r}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str, format: str = None):
+        """
+        Writes the metrics to a file, replacing it atomically so a reader never sees a partial file.
+
+        A file ending with ".prom" can be picked up by the textfile collector of the Prometheus node exporter.
+
+        :param path: The path of the file.
+        :type path: str
+        :param format: "json" or "prometheus". Defaults to "prometheus" for a path ending with ".prom" and to "json" otherwise.
+        :type format: str or None
+        :raises ValueError: If the format is unknown.
+        """
+        format = format or ("prometheus" if path.endswith(".prom") else "json")
+        if format == "json":
+            text = self.to_json(indent=2)
+        elif format == "prometheus":
+            text = self.to_prometheus()
+        else:
+            raise ValueError(f"Unknown format {format!r}, expected 'json' or 'prometheus'")
+        directory, filename = os.path.split(path)
+        tmp_path = os.path.join(directory, f".{filename}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+def _escape(value: str) -> str:
+    """
+    Escapes a Prometheus label value.
+    """
+    return re.sub(r'(["\\])', r'\\\1', str(value)).replace("\n", "\\n")
+
+def _format_bound(bound: float) -> str:
+    """
+    Formats the upper bound of a histogram bucket as a Prometheus "le" label.
+    """
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+collector = Telemetry()
+"""The collector shared by :py:mod:`data_gen` and :py:mod:`ft_an`."""
+
+def benchmark_overhead(n_calls: int = 100000) -> dict:
+    """
+    Measures the cost of timing a stage, to check that the collector can stay enabled.
+
+    :param n_calls: The number of timed calls.
+    :type n_calls: int
+    :return: A dict with the number of 'calls' and the microseconds per call of an empty loop ('baseline_us'), an enabled collector ('enabled_us') and a disabled collector ('disabled_us').
+    :rtype: dict
+    """
+    report = {'calls': n_calls}
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        pass
+    baseline = time.perf_counter() - start
+    report['baseline_us'] = baseline / n_calls * 1e6
+    for key, enabled in (('enabled_us', True), ('disabled_us', False)):
+        telemetry = Telemetry(enabled=enabled)
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            with telemetry.stage("benchmark", items=1):
+                pass
+        report[key] = (time.perf_counter() - start) / n_calls * 1e6
+    return report
@@ -0,0 +1,40 @@
+"""
+Shared fixtures of the tests.
+
+The modules in docs/source are extracts of notebooks, so the libraries they use (``pd``, ``np``, ``requests``) are globals of the notebook and are set here.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'docs', 'source'))
+
+import data_gen as _data_gen
+import ft_an as _ft_an
+
+@pytest.fixture
+def data_gen(monkeypatch):
+    """
+    Returns the data_gen module with the notebook globals set, without a prompt cache and with fresh rate limiters.
+    """
+    monkeypatch.setattr(_data_gen, 'pd', pd, raising=False)
+    monkeypatch.setattr(_data_gen, 'np', np, raising=False)
+    monkeypatch.setattr(_data_gen, 'requests', requests, raising=False)
+    monkeypatch.setattr(_data_gen, 'prompt_cache', None)
+    monkeypatch.setattr(_data_gen, 'rate_limiters', {})
+    return _data_gen
+
+@pytest.fixture
+def ft_an(monkeypatch):
+    """
+    Returns the ft_an module with the notebook globals set and an empty model registry.
+    """
+    monkeypatch.setattr(_ft_an, 'pd', pd, raising=False)
+    monkeypatch.setattr(_ft_an, 'np', np, raising=False)
+    monkeypatch.setattr(_ft_an, 'model_registry', _ft_an.ModelRegistry())
+    return _ft_an
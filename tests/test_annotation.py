@@ -0,0 +1,25 @@
+"""
+Tests of the annotation in ft_an, with a fake pipeline in place of a question-answering model.
+"""
+
+import pandas as pd
+
+def fake_pipeline(question, context, batch_size=1):
+    if isinstance(question, str):
+        if question.startswith("fail"):
+            raise ValueError("the model cannot answer " + question)
+        return {'answer': context.split()[0], 'score': 0.5, 'start': 0, 'end': len(context.split()[0])}
+    return [fake_pipeline(q, c) for q, c in zip(question, context)]
+
+def test_annotate_stream_shards_share_a_schema_when_every_row_of_a_chunk_fails(ft_an, tmp_path):
+    ft_an.model_registry.loader = lambda model_checkpoint, device, backend: fake_pipeline
+    input_path = str(tmp_path / "input.csv")
+    pd.DataFrame({'question': ["fail 1", "fail 2", "who", "what"], 'context': ["x", "y", "Alice asked", "Bob said"]}).to_csv(input_path, index=False)
+
+    paths = ft_an.annotate_stream(input_path, str(tmp_path / "shards"), "fake", chunk_size=2)
+
+    assert len(paths) == 2
+    df = pd.read_parquet(tmp_path / "shards")
+    assert df.index.tolist() == [0, 1, 2, 3]
+    assert df['answers_fake'].tolist() == [None, None, {'answer': "Alice", 'answer_start': 0, 'model': "fake"}, {'answer': "Bob", 'answer_start': 0, 'model': "fake"}]
+    assert df['score_fake'].tolist() == [None, None, {'score': 0.5, 'model': "fake"}, {'score': 0.5, 'model': "fake"}]
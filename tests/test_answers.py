@@ -0,0 +1,25 @@
+"""
+Tests of the parsing of the answers of the SQuAD-like datasets in data_gen.
+"""
+
+import pytest
+
+EXPECTED = {'text': ['x'], 'answer_start': [1]}
+
+@pytest.mark.parametrize("value", [
+    [{'text': ['x'], 'answer_start': [1]}],
+    {'text': ['x'], 'answer_start': [1]},
+    "[{'text': ['x'], 'answer_start': [1]}]",
+    '[{"text": ["x"], "answer_start": [1]}]',
+    "[{'text': ['x'], 'answer_start': [1], 'extra': None}]",
+    "[{'text': ['x'], 'answer_start': [np.int64(1)]}]",
+])
+def test_to_answer_dict_reads_dicts_lists_and_their_reprs(data_gen, value):
+    assert data_gen.to_answer_dict(value) == EXPECTED
+
+def test_to_answer_dict_keeps_quotes_inside_the_text(data_gen):
+    assert data_gen.to_answer_dict("""[{'text': ["it's"], 'answer_start': [0]}]""")['text'] == ["it's"]
+
+@pytest.mark.parametrize("value", [None, "", "  ", "[]"])
+def test_to_answer_dict_returns_none_without_an_answer(data_gen, value):
+    assert data_gen.to_answer_dict(value) is None
@@ -0,0 +1,108 @@
+"""
+Tests of the concurrent and resumable generation in data_gen, with a FakeChat in place of the chat interface.
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+PROMPTS = [f"prompt {i}" for i in range(20)]
+
+def slow_echo(msg):
+    time.sleep(0.001 * (int(msg.split()[-1]) % 5)) #later prompts often finish first
+    return "Answer to " + msg
+
+def test_generate_concurrent_keeps_prompt_order(data_gen):
+    chat = data_gen.FakeChat(slow_echo)
+    results = data_gen.generate_concurrent(PROMPTS, chat, 'paid', max_workers=8)
+    assert results == [(prompt, "Answer to " + prompt) for prompt in PROMPTS]
+    assert chat.calls == len(PROMPTS)
+    assert len(chat.history) == 2 * len(PROMPTS)
+
+def test_generate_concurrent_calls_on_result_once_per_prompt(data_gen):
+    seen = {}
+    lock = threading.Lock()
+
+    def on_result(i, result):
+        with lock:
+            seen[i] = result
+
+    results = data_gen.generate_concurrent(PROMPTS, data_gen.FakeChat(slow_echo), 'paid', max_workers=4, on_result=on_result)
+    assert [seen[i] for i in range(len(PROMPTS))] == results
+
+def test_generate_concurrent_gives_every_worker_its_own_chat(data_gen):
+    sessions = []
+
+    class Session:
+        def __init__(self, model, history):
+            self.model = model
+            self.history = list(history)
+            self.thread = None
+
+        def send_message(self, msg):
+            assert self.thread in (None, threading.get_ident()), "a chat was shared between threads"
+            self.thread = threading.get_ident()
+            time.sleep(0.002)
+            self.history.append({"role": "user", "parts": msg})
+            return [SimpleNamespace(text="Answer to " + msg)]
+
+    class Model:
+        model_name = 'fake'
+
+        def start_chat(self, history=()):
+            sessions.append(Session(self, history))
+            return sessions[-1]
+
+    chat = Model().start_chat(history=[{"role": "user", "parts": "context"}])
+    chat.context = "context"
+    results = data_gen.generate_concurrent(PROMPTS, chat, 'paid', max_workers=4)
+    assert results == [(prompt, "Answer to " + prompt) for prompt in PROMPTS]
+    assert chat.history == [{"role": "user", "parts": "context"}] #the template chat is not used by the workers
+    workers = sessions[1:]
+    assert 1 <= len(workers) <= 4
+    assert all(worker.history[0] == {"role": "user", "parts": "context"} for worker in workers)
+    assert sum(len(worker.history) - 1 for worker in workers) == len(PROMPTS)
+
+def test_generate_concurrent_raises_and_stops_after_a_failure(data_gen):
+    def fail_on_third(msg):
+        if msg == "prompt 3":
+            raise RuntimeError("API error")
+        return slow_echo(msg)
+
+    chat = data_gen.FakeChat(fail_on_third, latency=0.005)
+    with pytest.raises(RuntimeError, match="API error"):
+        data_gen.generate_concurrent(PROMPTS, chat, 'paid', max_workers=2)
+    assert chat.calls < len(PROMPTS) #the queued prompts are cancelled
+
+def test_generate_resumable_skips_journaled_prompts(data_gen, tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+
+    def fail_on_tenth(msg):
+        if msg == "prompt 10":
+            raise RuntimeError("connection lost")
+        return "Answer to " + msg
+
+    with pytest.raises(RuntimeError):
+        data_gen.generate_resumable(PROMPTS, data_gen.FakeChat(fail_on_tenth), 'paid', max_workers=1, journal_path=journal_path)
+    journal = data_gen.GenerationJournal(journal_path)
+    journaled = sum(journal.get(i, prompt) is not None for i, prompt in enumerate(PROMPTS))
+    journal.close()
+    assert 0 < journaled < len(PROMPTS)
+
+    chat = data_gen.FakeChat(lambda msg: "Answer to " + msg)
+    results = data_gen.generate_resumable(PROMPTS, chat, 'paid', max_workers=4, journal_path=journal_path)
+    assert results == [(prompt, "Answer to " + prompt) for prompt in PROMPTS]
+    assert chat.calls == len(PROMPTS) - journaled
+
+def test_generate_batched_falls_back_to_single_requests(data_gen):
+    def responder(msg):
+        if msg.startswith("The following are"):
+            return "not a JSON array"
+        return "Answer to " + msg
+
+    chat = data_gen.FakeChat(responder)
+    results = data_gen.generate_batched(PROMPTS, chat, 'paid', max_workers=2, batch_size=5)
+    assert results == [(prompt, "Answer to " + prompt) for prompt in PROMPTS]
+    assert chat.calls == len(PROMPTS) // 5 + len(PROMPTS)
@@ -0,0 +1,38 @@
+"""
+Tests of the grouping of MULTI_SELECT options in data_gen.
+"""
+
+import pandas as pd
+import pytest
+
+INSTRUCTIONS = {'MULTI_SELECT': "Pick from {answer}: {question}", 'TEXT': "Rephrase {answer}: {question}"}
+
+@pytest.fixture
+def df_qa():
+    return pd.DataFrame({
+        'questionnaire': [1, 1, 2, 2, 2, 2],
+        'question': ["Q1", "Q1", "Q1", "Q2", "Q3", "Q3"], #Q1 runs on from questionnaire 1 into questionnaire 2
+        'type': ["MULTI_SELECT", "MULTI_SELECT", "MULTI_SELECT", "TEXT", "MULTI_SELECT", "MULTI_SELECT"],
+        'answer': ["x", "y", "z", "free text", "a", "b"],
+    })
+
+@pytest.mark.parametrize("one_per_group, by_questionnaire, expected_options, expected_groups", [
+    (False, False, ["x, y, z", "y, z", "z", "free text", "a, b", "b"], [0, 0, 0, 1, 2, 2]),
+    (True, False, ["x, y, z", "x, y, z", "x, y, z", "free text", "a, b", "a, b"], [0, 0, 0, 1, 2, 2]),
+    (False, True, ["x, y", "y", "z", "free text", "a, b", "b"], [0, 0, 1, 2, 3, 3]),
+    (True, True, ["x, y", "x, y", "z", "free text", "a, b", "a, b"], [0, 0, 1, 2, 3, 3]),
+])
+def test_group_options(data_gen, df_qa, one_per_group, by_questionnaire, expected_options, expected_groups):
+    options, group_ids = data_gen.group_options(df_qa, 'answer', 'question', 'type', one_per_group, by_questionnaire)
+    assert options.tolist() == expected_options
+    assert group_ids.tolist() == expected_groups
+
+@pytest.mark.parametrize("one_per_group, by_questionnaire, expected_calls", [(False, False, 6), (True, False, 3), (True, True, 4)])
+def test_generate_answers_sends_one_request_per_multi_select_question(data_gen, df_qa, monkeypatch, one_per_group, by_questionnaire, expected_calls):
+    monkeypatch.setattr(data_gen, 'instructions', INSTRUCTIONS, raising=False)
+    chat = data_gen.FakeChat()
+    df = data_gen.generate_answers(df_qa, 'answer', 'question', 'type', chat, 'paid', one_per_group=one_per_group, by_questionnaire=by_questionnaire)
+    assert chat.calls == expected_calls
+    assert len(set(df['answers_ft'])) == expected_calls #rows of a question share its answer
+    if one_per_group:
+        assert df.loc[0, 'prompts_a'] == df.loc[1, 'prompts_a'] == "Pick from x, y" + ("" if by_questionnaire else ", z") + ": Q1"
@@ -0,0 +1,93 @@
+"""
+Tests of the questionnaire ingestion in data_gen, with a local HTTP server in place of the questionnaire host.
+"""
+
+import collections
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+def questionnaire(k):
+    return {"question": f"Question {k}", "type": "SINGLE_SELECT", "options": [{"id": 1, "option": f"Option {k}a"}, {"id": 2, "option": f"Option {k}b"}]}
+
+@pytest.fixture
+def server():
+    """
+    Serves /q<k>.json. A path listed in ``server.failures`` answers with 503 as many times as given before it succeeds.
+    """
+    hits = collections.Counter()
+    failures = collections.Counter()
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                hits[self.path] += 1
+                fail = failures[self.path] > 0
+                failures[self.path] -= fail
+            if fail:
+                self.send_response(503)
+                self.end_headers()
+                return
+            k = int(self.path.strip('/').removeprefix('q').removesuffix('.json'))
+            body = json.dumps(questionnaire(k)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.hits = hits
+    httpd.failures = failures
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_iter_questionnaires_yields_in_order(data_gen, server):
+    urls = [f"{server.url}/q{k}.json" for k in range(1, 8)]
+    frames = list(data_gen.iter_questionnaires(urls, web=True, max_workers=3))
+    assert [df['question'].iloc[0] for df in frames] == [f"Question {k}" for k in range(1, 8)]
+    assert [df['questionnaire'].iloc[0] for df in frames] == list(range(1, 8))
+    assert all(len(df.index) == 2 for df in frames)
+
+def test_generate_data_web_matches_local_files(data_gen, server, tmp_path):
+    paths = []
+    for k in range(1, 4):
+        paths.append(str(tmp_path / f"q{k}.json"))
+        with open(paths[-1], 'w') as f:
+            json.dump(questionnaire(k), f)
+    web = data_gen.generate_data_web([f"{server.url}/q{k}.json" for k in range(1, 4)], max_workers=2)
+    local = data_gen.generate_data(paths)
+    assert web.equals(local)
+
+def test_fetch_retries_server_errors(data_gen, server):
+    server.failures['/q1.json'] = 2
+    df = data_gen.generate_data_web([f"{server.url}/q1.json"], max_workers=1, retries=3)
+    assert df['question'].tolist() == ["Question 1", "Question 1"]
+    assert server.hits['/q1.json'] == 3
+
+def test_fetch_gives_up_after_the_retries(data_gen, server):
+    server.failures['/q1.json'] = 5
+    with pytest.raises(data_gen.requests.exceptions.RetryError):
+        data_gen.generate_data_web([f"{server.url}/q1.json"], max_workers=1, retries=1)
+    assert server.hits['/q1.json'] == 2
+
+def test_cached_download_is_not_fetched_again(data_gen, server, tmp_path):
+    urls = [f"{server.url}/q{k}.json" for k in range(1, 4)]
+    cache_dir = str(tmp_path / "cache")
+    first = data_gen.generate_data_web(urls, max_workers=2, cache_dir=cache_dir)
+    assert sum(server.hits.values()) == 3
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.json')]) == 3
+    second = data_gen.generate_data_web(urls, max_workers=2, cache_dir=cache_dir)
+    assert sum(server.hits.values()) == 3
+    assert second.equals(first)
@@ -0,0 +1,76 @@
+"""
+Tests of the sliding window rate limiter in data_gen, with windows of a fraction of a second instead of a minute.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+PERIOD = 0.2
+TOLERANCE = 0.02 #of the sleep and clock resolution
+
+def test_rate_limiter_spreads_threads_over_the_window(data_gen):
+    limiter = data_gen.RateLimiter(rpm=2, period=PERIOD)
+    sent = []
+    lock = threading.Lock()
+
+    def send():
+        limiter.acquire()
+        with lock:
+            sent.append(time.monotonic())
+
+    threads = [threading.Thread(target=send) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    sent.sort()
+    assert all(later - earlier >= PERIOD - TOLERANCE for earlier, later in zip(sent, sent[2:])) #never more than rpm requests within one window
+    assert sent[-1] - sent[0] < 2 * PERIOD + 0.1 #the third window starts right after the second
+    assert limiter.metrics()['requests'] == 6
+    assert limiter.metrics()['throttled_requests'] == 4
+
+def test_rate_limiter_reserves_tokens_per_window(data_gen):
+    limiter = data_gen.RateLimiter(rpm=100, tpm=10, period=PERIOD)
+    assert limiter.acquire(6) == 0
+    assert limiter.acquire(6) == pytest.approx(PERIOD, abs=TOLERANCE) #waits until the first request leaves the window
+    assert limiter.acquire(4) == 0 #fits next to the second request
+    assert limiter.acquire(1) == pytest.approx(PERIOD, abs=TOLERANCE)
+
+def test_rate_limiter_clamps_requests_larger_than_the_token_limit(data_gen):
+    limiter = data_gen.RateLimiter(rpm=100, tpm=10, period=PERIOD)
+    assert limiter.acquire(50) == 0 #would never fit into a window otherwise
+    assert limiter._window_tokens == 10
+    assert limiter.acquire(1) == pytest.approx(PERIOD, abs=TOLERANCE)
+
+def test_rate_limiter_waits_without_blocking_the_event_loop(data_gen):
+    limiter = data_gen.RateLimiter(rpm=2, period=PERIOD)
+
+    async def send_all():
+        start = time.monotonic()
+        waits = await asyncio.gather(*[limiter.acquire_async() for _ in range(4)])
+        return waits, time.monotonic() - start
+
+    waits, seconds = asyncio.run(send_all())
+    assert sorted(waits) == [0, 0, pytest.approx(PERIOD, abs=TOLERANCE), pytest.approx(PERIOD, abs=TOLERANCE)]
+    assert seconds < 1.5 * PERIOD #the throttled requests wait concurrently
+
+def test_estimate_request_tokens_counts_the_chat_history(data_gen):
+    chat = data_gen.FakeChat()
+    message = "How many employees does the company have?"
+    assert data_gen.estimate_request_tokens(message, chat) == data_gen.estimate_tokens(message)
+    chat.send_message("x" * 400)
+    assert data_gen.estimate_request_tokens(message, chat) > data_gen.estimate_tokens(message) + 100
+
+def test_generate_with_msg_reserves_the_resent_history(data_gen, monkeypatch):
+    limiter = data_gen.get_rate_limiter('paid')
+    reserved = []
+    monkeypatch.setattr(limiter, 'acquire', lambda tokens=1: reserved.append(tokens) or 0.0)
+    chat = data_gen.FakeChat()
+    for _ in range(3):
+        data_gen.generate_with_msg("y" * 400, chat, 'paid')
+    assert reserved[0] == data_gen.estimate_tokens("y" * 400)
+    assert reserved[0] < reserved[1] < reserved[2]